@@ -0,0 +1,139 @@
+"""
+Caches the choices of reference form fields in Django's cache framework.
+
+The cache keys contain a generation token per collection. Saving or deleting
+a document replaces the token of its collection, which invalidates all
+cached choices for that collection at once. The receivers are connected
+for a document class when a reference field that caches its choices is
+given a queryset of it, so documents nobody caches choices for cost
+nothing. Only writes that send mongoengine's ``post_save`` and
+``post_delete`` signals are noticed, so ``QuerySet.update`` and bulk
+writes are not, and neither are writes of processes that never create
+such a field.
+"""
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+try:
+    from django.core.cache import caches
+
+    def get_cache(alias):
+        return caches[alias]
+except ImportError:
+    # Django < 1.7
+    from django.core.cache import get_cache
+
+from mongoengine import signals
+
+CACHE_PREFIX = 'mongodbforms.choices'
+
+
+
+def _get_cache():
+    return get_cache(getattr(settings, 'MONGODBFORMS_CHOICE_CACHE', 'default'))
+
+
+def _generation_key(collection_name):
+    return '%s.generation.%s' % (CACHE_PREFIX, collection_name)
+
+
+def _get_generation(cache, collection_name):
+    key = _generation_key(collection_name)
+    generation = cache.get(key)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        # don't expire the generation before the choices it belongs to
+        cache.set(key, generation, None)
+    return generation
+
+
+def invalidate(document):
+    """Drops all cached choices for the collection of ``document``."""
+    collection_name = document._get_collection_name()
+    cache = _get_cache()
+    cache.set(_generation_key(collection_name), uuid.uuid4().hex, None)
+
+
+def _invalidate_receiver(sender, **kwargs):
+    # always invalidate: choices may have been cached by another process
+    invalidate(sender)
+
+
+def watch(document):
+    """
+    Invalidates the cached choices for ``document`` whenever one of its
+    instances is saved or deleted.
+    """
+    if not signals.signals_available:
+        raise ImproperlyConfigured(
+            "Caching choices requires blinker to invalidate the cache "
+            "on changes to the referenced documents.")
+    # connecting a receiver twice for the same sender is a no-op
+    signals.post_save.connect(_invalidate_receiver, sender=document)
+    signals.post_delete.connect(_invalidate_receiver, sender=document)
+
+
+def queryset_signature(queryset):
+    """
+    Returns a hash of everything that determines which documents a
+    queryset returns and how they are loaded.
+    """
+    loaded_fields = queryset._loaded_fields
+    if hasattr(loaded_fields, 'as_dict'):
+        loaded_fields = loaded_fields.as_dict()
+    signature = repr((
+        queryset._document._get_collection_name(),
+        queryset._query,
+        queryset._ordering,
+        loaded_fields,
+        queryset._skip,
+        queryset._limit,
+    ))
+    return hashlib.md5(signature.encode('utf-8')).hexdigest()
+
+
+def _label_key(field):
+    """
+    Returns what tells the labels of ``field`` apart from those of other
+    fields of its class: its ``choice_cache_key`` if set, otherwise the
+    name and position of a ``label_from_instance`` set on the instance.
+    """
+    if field.choice_cache_key is not None:
+        return field.choice_cache_key
+    label = field.__dict__.get('label_from_instance')
+    if label is None:
+        # a method of the field class, which is part of the key anyway
+        return ''
+    func = getattr(label, '__func__', label)
+    code = getattr(func, '__code__', None)
+    return '%s.%s:%s' % (
+        getattr(func, '__module__', ''),
+        getattr(func, '__qualname__', getattr(func, '__name__', '')),
+        code.co_firstlineno if code is not None else repr(type(func)),
+    )
+
+
+def get_choices(field, queryset, build_choices):
+    """
+    Returns the cached choices of ``field`` for ``queryset``. If there are
+    none ``build_choices`` is called and its result is cached for
+    ``field.choice_cache_timeout`` seconds.
+    """
+    watch(queryset._document)
+    collection_name = queryset._document._get_collection_name()
+
+    cache = _get_cache()
+    label_key = hashlib.md5(_label_key(field).encode('utf-8')).hexdigest()
+    key = '%s.%s.%s.%s.%s.%s.%s' % (
+        CACHE_PREFIX, collection_name,
+        _get_generation(cache, collection_name),
+        field.__class__.__module__, field.__class__.__name__,
+        queryset_signature(queryset), label_key,
+    )
+    choices = cache.get(key)
+    if choices is None:
+        choices = list(build_choices())
+        cache.set(key, choices, field.choice_cache_timeout)
+    return choices
@@ -1,4 +1,5 @@
 import sys
+import threading
 from collections import MutableMapping
 from types import MethodType
 
@@ -39,8 +40,7 @@ class Relation(object):
 
     @property
     def to(self):
-        if not isinstance(self._to._meta, (DocumentMetaWrapper, LazyDocumentMetaWrapper)):
-            self._to._meta = DocumentMetaWrapper(self._to)
+        get_meta_wrapper(self._to)
         return self._to
 
     @to.setter
@@ -49,21 +49,43 @@ class Relation(object):
 
 
 class PkWrapper(object):
-    editable = False
-    fake = False
+    """
+    Proxies the pk field of a document and adds the attributes Django
+    expects on it. Everything else is read from the wrapped field.
+    """
+    __slots__ = ('obj', 'name', 'attname', 'editable', 'fake')
+
+    # names defined on the class of a wrapped field, used for dir()
+    _class_names = {}
 
     def __init__(self, wrapped):
-        self.obj = wrapped
+        object.__setattr__(self, 'obj', wrapped)
+        object.__setattr__(self, 'editable', False)
+        object.__setattr__(self, 'fake', False)
 
     def __getattr__(self, attr):
-        if attr in dir(self.obj):
-            return getattr(self.obj, attr)
-        raise AttributeError
+        # only called for unset slots and names the wrapper doesn't have
+        try:
+            obj = object.__getattribute__(self, 'obj')
+            return getattr(obj, attr)
+        except AttributeError:
+            raise AttributeError(attr)
 
     def __setattr__(self, attr, value):
-        if attr != 'obj' and hasattr(self.obj, attr):
+        if attr in PkWrapper.__slots__:
+            if attr != 'obj' and hasattr(self.obj, attr):
+                setattr(self.obj, attr, value)
+            object.__setattr__(self, attr, value)
+        else:
             setattr(self.obj, attr, value)
-        super(PkWrapper, self).__setattr__(attr, value)
+
+    def __dir__(self):
+        cls = type(self.obj)
+        names = PkWrapper._class_names.get(cls)
+        if names is None:
+            names = PkWrapper._class_names[cls] = frozenset(dir(cls))
+        names = names.union(getattr(self.obj, '__dict__', ()))
+        return sorted(names.union(PkWrapper.__slots__))
 
 
 class LazyDocumentMetaWrapper(LazyObject):
@@ -76,7 +98,7 @@ class LazyDocumentMetaWrapper(LazyObject):
         super(LazyDocumentMetaWrapper, self).__init__()
 
     def _setup(self):
-        self._wrapped = DocumentMetaWrapper(self._document, self._meta)
+        self._wrapped = get_meta_wrapper(self._document)
 
     def __setattr__(self, name, value):
         if name in ["_document", "_meta", ]:
@@ -99,28 +121,35 @@ class DocumentMetaWrapper(MutableMapping):
     # attributes Django deprecated. Not really sure when to remove them
     _deprecated_attrs = {'module_name': 'model_name'}
 
-    pk = None
-    pk_name = None
-    _app_label = None
-    model_name = None
-    _verbose_name = None
-    has_auto_field = False
-    object_name = None
-    proxy = []
-    proxied_children = []
-    parents = {}
-    many_to_many = []
-    _field_cache = None
-    document = None
-    _meta = None
-    concrete_model = None
-    concrete_managers = []
-    virtual_fields = []
-    auto_created = False
+    # The attributes Django expects on a model's Options are slots. All
+    # other attributes are read from and written to the wrapped meta dict.
+    # Python 2's MutableMapping has no __slots__, so wrappers there still
+    # carry an (unused) instance dict.
+    __slots__ = ('document', '_meta', 'concrete_model', 'pk', 'pk_name',
+                 '_app_label', 'model_name', '_verbose_name',
+                 'has_auto_field', 'object_name', 'proxy', 'proxied_children',
+                 'parents', 'many_to_many', 'concrete_managers',
+                 'virtual_fields', 'auto_created', '_field_cache',
+                 '_field_tables')
 
     def __init__(self, document, meta=None):
         super(DocumentMetaWrapper, self).__init__()
 
+        self.pk = None
+        self.pk_name = None
+        self._app_label = None
+        self._verbose_name = None
+        self.has_auto_field = False
+        self.proxy = []
+        self.proxied_children = []
+        self.parents = {}
+        self.many_to_many = []
+        self.concrete_managers = []
+        self.virtual_fields = []
+        self.auto_created = False
+        self._field_cache = None
+        self._field_tables = None
+
         self.document = document
         # used by Django to distinguish between abstract and concrete models
         # here for now always the document
@@ -138,56 +167,61 @@ class DocumentMetaWrapper(MutableMapping):
 
         self.model_name = self.object_name.lower()
 
-        # add the gluey stuff to the document and it's fields to make
-        # everything play nice with Django
-        self._setup_document_fields()
+        # The gluey stuff that makes the document's fields play nice with
+        # Django is added by _setup_field when a field is first looked up.
         # Setup self.pk if the document has an id_field in it's meta
         # if it doesn't have one it's an embedded document
         # if 'id_field' in self._meta:
         #    self.pk_name = self._meta['id_field']
         self._init_pk()
 
-    def _setup_document_fields(self):
-        for f in self.document._fields.values():
-            # Yay, more glue. Django expects fields to have a couple attributes
-            # at least in the admin, probably in more places.
-            if not hasattr(f, 'rel'):
-                # need a bit more for actual reference fields here
-                if isinstance(f, ReferenceField):
-                    # FIXME: Probably broken in Django 1.7
-                    f.rel = Relation(f.document_type)
-                    f.is_relation = True
-                elif isinstance(f, ListField) and isinstance(f.field, ReferenceField):
-                    # FIXME: Probably broken in Django 1.7
-                    f.field.rel = Relation(f.field.document_type)
-                    f.field.is_relation = True
-                else:
-                    f.many_to_many = None
-                    f.many_to_one = None
-                    f.one_to_many = None
-                    f.one_to_one = None
-                    f.related_model = None
-
-                    # FIXME: No longer used in Django 1.7?
-                    f.rel = None
-                    f.is_relation = False
-            if not hasattr(f, 'verbose_name') or f.verbose_name is None:
-                f.verbose_name = capfirst(create_verbose_name(f.name))
-            if not hasattr(f, 'flatchoices'):
-                flat = []
-                if f.choices is not None:
-                    for choice, value in f.choices:
-                        if isinstance(value, (list, tuple)):
-                            flat.extend(value)
-                        else:
-                            flat.append((choice, value))
-                f.flatchoices = flat
-            if isinstance(f, ReferenceField) and not \
-                    isinstance(f.document_type._meta, (DocumentMetaWrapper, LazyDocumentMetaWrapper)) and \
-                    self.document != f.document_type:
-                f.document_type._meta = LazyDocumentMetaWrapper(f.document_type)
-            if not hasattr(f, 'auto_created'):
-                f.auto_created = False
+    def _setup_field(self, f):
+        # Yay, more glue. Django expects fields to have a couple attributes
+        # at least in the admin, probably in more places.
+        if getattr(f, '_django_glue', False):
+            return f
+        if not hasattr(f, 'rel'):
+            # need a bit more for actual reference fields here
+            if isinstance(f, ReferenceField):
+                # FIXME: Probably broken in Django 1.7
+                f.rel = Relation(f.document_type)
+                f.is_relation = True
+            elif isinstance(f, ListField) and isinstance(f.field, ReferenceField):
+                # FIXME: Probably broken in Django 1.7
+                f.field.rel = Relation(f.field.document_type)
+                f.field.is_relation = True
+            else:
+                f.many_to_many = None
+                f.many_to_one = None
+                f.one_to_many = None
+                f.one_to_one = None
+                f.related_model = None
+
+                # FIXME: No longer used in Django 1.7?
+                f.rel = None
+                f.is_relation = False
+        if not hasattr(f, 'verbose_name') or f.verbose_name is None:
+            f.verbose_name = capfirst(create_verbose_name(f.name))
+        if not hasattr(f, 'help_text'):
+            # mongoengine < 0.9 had help_text on all fields
+            f.help_text = None
+        if not hasattr(f, 'flatchoices'):
+            flat = []
+            if f.choices is not None:
+                for choice, value in f.choices:
+                    if isinstance(value, (list, tuple)):
+                        flat.extend(value)
+                    else:
+                        flat.append((choice, value))
+            f.flatchoices = flat
+        if isinstance(f, ReferenceField) and not \
+                isinstance(f.document_type._meta, (DocumentMetaWrapper, LazyDocumentMetaWrapper)) and \
+                self.document != f.document_type:
+            f.document_type._meta = LazyDocumentMetaWrapper(f.document_type)
+        if not hasattr(f, 'auto_created'):
+            f.auto_created = False
+        f._django_glue = True
+        return f
 
     def _init_pk(self):
         """
@@ -270,15 +304,13 @@ class DocumentMetaWrapper(MutableMapping):
         for this field (since the field doesn't have an instance associated
         with it).
         """
-        if name in self.document._fields:
-            field = self.document._fields[name]
-            if isinstance(field, ReferenceField):
-                return (field, field.document_type, False, False)
-            else:
-                return (field, None, True, False)
-        else:
+        try:
+            result = self._get_field_tables()[1][name]
+        except KeyError:
             raise FieldDoesNotExist('%s has no field named %r' %
                                     (self.object_name, name))
+        self._setup_field(result[0])
+        return result
 
     def get_field(self, name, many_to_many=True):
         """
@@ -287,7 +319,32 @@ class DocumentMetaWrapper(MutableMapping):
         return self.get_field_by_name(name)[0]
 
     def get_fields(self, include_hidden=False):
-        return self.document._fields.values()
+        fields = self._get_field_tables()[2]
+        for f in fields:
+            self._setup_field(f)
+        return fields
+
+    def _get_field_tables(self):
+        """
+        Returns a ``(key, by_name, fields)`` tuple. ``by_name`` maps the
+        field names to the tuples returned by get_field_by_name, ``fields``
+        is a tuple of all fields. The tables are built on first use and
+        rebuilt if the document's ``_fields`` change. They don't set up the
+        fields, that is left to the lookups.
+        """
+        fields = self.document._fields
+        key = (id(fields), len(fields))
+        tables = self._field_tables
+        if tables is None or tables[0] != key:
+            by_name = {}
+            for name, f in fields.items():
+                if isinstance(f, ReferenceField):
+                    by_name[name] = (f, f.document_type, False, False)
+                else:
+                    by_name[name] = (f, None, True, False)
+            tables = (key, by_name, tuple(fields.values()))
+            self._field_tables = tables
+        return tables
 
     @property
     def swapped(self):
@@ -321,19 +378,20 @@ class DocumentMetaWrapper(MutableMapping):
         return None
 
     def __getattr__(self, name):
+        # only called for names that are neither slots nor class attributes
         if name in self._deprecated_attrs:
-            return getattr(self, self._deprecated_attrs.get(name))
-
+            return getattr(self, self._deprecated_attrs[name])
         try:
-            return self._meta[name]
-        except KeyError:
-            raise AttributeError
+            # _meta may not be set yet, e.g. while the wrapper is copied
+            return object.__getattribute__(self, '_meta')[name]
+        except (KeyError, AttributeError):
+            raise AttributeError(name)
 
     def __setattr__(self, name, value):
-        if not hasattr(self, name):
-            self._meta[name] = value
+        if hasattr(type(self), name):
+            object.__setattr__(self, name, value)
         else:
-            super(DocumentMetaWrapper, self).__setattr__(name, value)
+            self._meta[name] = value
 
     def __contains__(self, key):
         return key in self._meta
@@ -373,3 +431,40 @@ class DocumentMetaWrapper(MutableMapping):
 
     def iteritems(self):
         return iter(self._meta.items())
+
+
+_meta_wrappers_lock = threading.RLock()
+
+
+def _installed_wrapper(document):
+    meta = getattr(document, '_meta', None)
+    if isinstance(meta, DocumentMetaWrapper) and meta.document is document:
+        return meta
+    return None
+
+
+def get_meta_wrapper(document):
+    """
+    Returns the DocumentMetaWrapper of ``document`` and installs it as the
+    document's ``_meta``. There is exactly one wrapper per document class,
+    it is only created on first use and creating it is thread safe. The
+    installed ``_meta`` is the only reference to the wrapper.
+    """
+    wrapper = _installed_wrapper(document)
+    if wrapper is not None:
+        return wrapper
+    with _meta_wrappers_lock:
+        wrapper = _installed_wrapper(document)
+        if wrapper is None:
+            meta = getattr(document, '_meta', {})
+            if isinstance(meta, LazyDocumentMetaWrapper):
+                meta = meta._meta
+            if isinstance(meta, DocumentMetaWrapper) and \
+                    meta.document is document:
+                wrapper = meta
+            else:
+                if isinstance(meta, DocumentMetaWrapper):
+                    meta = meta._meta
+                wrapper = DocumentMetaWrapper(document, meta)
+            document._meta = wrapper
+    return wrapper
@@ -1,17 +1,29 @@
-import os
+import copy
 import itertools
+import operator
 from collections import Callable, OrderedDict
 from functools import reduce
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2 needs the futures backport for concurrent uploads
+    ThreadPoolExecutor = None
 
+from django.conf import settings
 from django.forms.forms import (BaseForm, DeclarativeFieldsMetaclass,
                                 NON_FIELD_ERRORS, pretty_name)
 from django.forms.widgets import media_property
-from django.core.exceptions import FieldError
+from django.core.exceptions import (FieldError,
+                                    ValidationError as DjangoValidationError)
 from django.core.validators import EMPTY_VALUES
 from django.forms.util import ErrorList
 from django.forms.formsets import BaseFormSet, formset_factory
 from django.utils.translation import ugettext_lazy as _, ugettext
-from django.utils.text import capfirst, get_valid_filename
+from django.utils.text import capfirst, get_text_list
+try:
+    from django.utils.encoding import force_text as force_unicode
+except ImportError:
+    from django.utils.encoding import force_unicode
 
 from mongoengine.fields import (ObjectIdField, ListField, ReferenceField,
                                 FileField, MapField, EmbeddedDocumentField)
@@ -21,32 +33,116 @@ except ImportError:
     from mongoengine.errors import ValidationError
 from mongoengine.queryset import OperationError, Q
 from mongoengine.queryset.base import BaseQuerySet
-from mongoengine.connection import get_db, DEFAULT_CONNECTION_NAME
 from mongoengine.base import NON_FIELD_ERRORS as MONGO_NON_FIELD_ERRORS
 
-from gridfs import GridFS
-
-from mongodbforms.documentoptions import DocumentMetaWrapper
-from mongodbforms.util import with_metaclass, load_field_generator
+try:  # objectid was moved into bson in pymongo 1.9
+    from bson.errors import InvalidId
+except ImportError:
+    from pymongo.errors import InvalidId
+from pymongo.errors import PyMongoError
+try:
+    from pymongo import UpdateOne
+    from pymongo.errors import BulkWriteError
+except ImportError:
+    # bulk writes are new in pymongo 3.0
+    UpdateOne = BulkWriteError = None
+
+from gridfs.errors import GridFSError
+from mongodbforms.documentoptions import get_meta_wrapper
+from mongodbforms.fields import (ReferenceField as ReferenceFormField,
+                                 DocumentMultipleChoiceField)
+from mongodbforms.util import (with_metaclass, load_field_generator,
+                               LRUCache)
+from mongodbforms import choicecache
+from mongodbforms.choicecache import queryset_signature
+from mongodbforms.identitymap import IdentityMap, is_unfiltered
+from mongodbforms.filestorage import (put_file, delete_file,
+                                      choose_filenames, delete_document,
+                                      delete_documents, DeletionQueue)
 
 _fieldgenerator = load_field_generator()
 
+# errors that fail a file upload
+UPLOAD_ERRORS = (PyMongoError, GridFSError, EnvironmentError)
+
+# form and formset classes generated by the factories
+_form_class_cache = LRUCache(
+    getattr(settings, 'MONGODBFORMS_FORM_CACHE_SIZE', 128))
+
+
+def _freeze(value):
+    """
+    Turns a value as returned by ``to_mongo`` into something hashable. Lists
+    are compared regardless of their order, like the unique checks do.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(sorted((_freeze(v) for v in value), key=repr))
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
 
-def _get_unique_filename(name, db_alias=DEFAULT_CONNECTION_NAME,
-                         collection_name='fs'):
-    fs = GridFS(get_db(db_alias), collection_name)
-    file_root, file_ext = os.path.splitext(get_valid_filename(name))
-    count = itertools.count(1)
-    while fs.exists(filename=name):
-        # file_ext includes the dot.
-        name = os.path.join("%s_%s%s" % (file_root, next(count), file_ext))
-    return name
+def _unique_check_key(document, lookups):
+    """
+    Returns a hashable key for the values of a unique check. Raises a
+    ``TypeError`` if one of the values can't be hashed.
+    """
+    key = []
+    for name, value in lookups:
+        field = document._fields[name]
+        if value is not None:
+            value = field.to_mongo(value)
+        key.append(_freeze(value))
+    key = tuple(key)
+    hash(key)
+    return key
+
+
+def _raw_unique_check_key(document, names, raw):
+    """
+    Returns the key of ``_unique_check_key`` for a document as returned by
+    ``as_pymongo``.
+    """
+    return tuple(_freeze(raw.get(document._fields[n].db_field))
+                 for n in names)
 
 
-def _save_iterator_file(field, instance, uploaded_file, file_data=None):
+def _unique_check_q(document, lookups):
+    """
+    Returns a ``Q`` object that matches the documents violating a unique
+    check. ``lookups`` is a list of ``(field_name, value)`` tuples.
+    """
+    q = Q()
+    for name, value in lookups:
+        field = document._fields[name]
+        # handling ListField(ReferenceField()) sucks big time
+        # What we need to do is construct a Q object that
+        # queries for the pk of every list entry and only
+        # accepts lists with the same length as our list
+        if isinstance(field, ListField) and \
+                isinstance(field.field, ReferenceField):
+            value = value or []
+            for k in value:
+                q = q & Q(**{name: k.pk})
+            q = q & Q(**{'%s__size' % name: len(value)})
+        else:
+            q = q & Q(**{name: value})
+    return q
+
+
+def _pk_to_mongo(obj):
+    pk_field = obj._fields[obj._meta['id_field']]
+    return pk_field.to_mongo(obj.pk)
+
+
+def _save_iterator_file(field, instance, uploaded_file, file_data=None,
+                        filename=None, replaced=None):
     """
     Takes care of saving a file for a list field. Returns a Mongoengine
-    fileproxy object or the file field.
+    fileproxy object or the file field. A file ``file_data`` had before is
+    added to the ``replaced`` deletion queue, so it is only deleted once
+    the document was saved. Without a queue it is left for the
+    ``gridfs_cleanup`` command, as the document isn't saved yet.
     """
     # for a new file we need a new proxy object
     if file_data is None:
@@ -58,19 +154,190 @@ def _save_iterator_file(field, instance, uploaded_file, file_data=None):
     if file_data.key is None:
         file_data.key = field.name
 
-    if file_data.grid_id:
-        file_data.delete()
-
-    uploaded_file.seek(0)
-    filename = _get_unique_filename(uploaded_file.name, field.field.db_alias,
-                                    field.field.collection_name)
-    file_data.put(uploaded_file, content_type=uploaded_file.content_type,
-                  filename=filename)
+    # the replaced file is only deleted once the new one is written
+    old_grid_id = file_data.grid_id
+    put_file(file_data, uploaded_file, field.field, filename)
     file_data.close()
+    if old_grid_id and replaced is not None:
+        replaced.add(file_data.db_alias, file_data.collection_name,
+                     old_grid_id)
 
     return file_data
 
 
+class LazyInitial(object):
+    """
+    Wraps a callable initial value and calls it at most once.
+    """
+    _unset = object()
+
+    def __init__(self, default):
+        self.default = default
+        self.value = self._unset
+
+    def __call__(self):
+        if self.value is self._unset:
+            self.value = self.default()
+        return self.value
+
+
+class ConstructPlan(object):
+    """
+    The assignments ``construct_instance`` makes for a document and a
+    ``fields``/``exclude`` combination. ``plain`` holds the names of the
+    fields that are simply set, ``files`` holds ``(name, kind)`` pairs for
+    file fields, which are saved after the other fields so a callable
+    ``upload_to`` can use their values. ``kind`` is one of ``'file'``,
+    ``'list'`` or ``'map'``. ``skipped`` holds the names of the fields that
+    are never assigned.
+    """
+
+    def __init__(self, document_fields, fields=None, exclude=None):
+        self.document_fields = document_fields
+        self.fields = fields
+        self.exclude = exclude
+        plain = []
+        files = []
+        skipped = []
+        field_names = set(fields) if fields is not None else None
+        exclude_names = set(exclude or ())
+        for f in document_fields.values():
+            if isinstance(f, ObjectIdField) or f.name in exclude_names or \
+                    (field_names is not None and f.name not in field_names):
+                skipped.append(f.name)
+            elif isinstance(f, FileField):
+                files.append((f.name, 'file'))
+            elif isinstance(f, MapField) and isinstance(f.field, FileField):
+                files.append((f.name, 'map'))
+            elif isinstance(f, ListField) and isinstance(f.field, FileField):
+                files.append((f.name, 'list'))
+            else:
+                plain.append(f.name)
+        self.plain = tuple(plain)
+        self.files = tuple(files)
+        self.skipped = tuple(skipped)
+
+    def matches(self, instance, fields, exclude):
+        return (instance._fields is self.document_fields and
+                fields == self.fields and exclude == self.exclude)
+
+
+def _get_upload_workers(form):
+    workers = getattr(getattr(form, '_meta', None), 'upload_workers', None)
+    if workers is None:
+        workers = getattr(settings, 'MONGODBFORMS_UPLOAD_WORKERS', 1)
+    return workers
+
+
+def _map_uploads(function, items, workers):
+    """
+    Calls ``function`` for each of ``items`` and returns a list of
+    ``(result, error)`` pairs in the order of ``items``. With more than one
+    worker the calls run on a thread pool.
+    """
+    def call(item):
+        try:
+            return function(item), None
+        except UPLOAD_ERRORS as e:
+            return None, e
+
+    if workers > 1 and len(items) > 1 and ThreadPoolExecutor is not None:
+        with ThreadPoolExecutor(max_workers=min(workers, len(items))) as pool:
+            return list(pool.map(call, items))
+    return [call(item) for item in items]
+
+
+def _save_container_files(f, instance, uploads, get_old, set_new, workers,
+                          replaced):
+    """
+    Saves the files of a list or map field. ``uploads`` holds
+    ``(index or key, upload)`` pairs. All new files are written before
+    anything in the container changes. If one of them fails the others are
+    deleted again and the error is raised, otherwise the new files are put
+    into place in the order of ``uploads`` and the replaced ones added to
+    the ``replaced`` deletion queue.
+    """
+    uploads = [(slot, upload) for slot, upload in uploads
+               if upload is not None]
+    # uploads with the same name must not get the same filename, so the
+    # names are chosen here and only the data is written concurrently
+    filenames = choose_filenames(f.field,
+                                 [upload for slot, upload in uploads])
+    results = _map_uploads(
+        lambda item: _save_iterator_file(f, instance, item[0][1],
+                                         filename=item[1]),
+        list(zip(uploads, filenames)), workers)
+    errors = [error for file_data, error in results if error is not None]
+    if errors:
+        _map_uploads(delete_file, [file_data for file_data, error in results
+                                   if error is None], workers)
+        raise errors[0]
+
+    for (slot, upload), (file_data, error) in zip(uploads, results):
+        old = get_old(slot)
+        if old is not None and old.grid_id:
+            replaced.add(old.db_alias, old.collection_name, old.grid_id)
+        set_new(slot, file_data)
+
+
+def _save_map_files(f, instance, uploads, workers, replaced):
+    map_field = getattr(instance, f.name)
+
+    def set_new(key, file_data):
+        map_field[key] = file_data
+    _save_container_files(f, instance, list(uploads.items()), map_field.get,
+                          set_new, workers, replaced)
+    setattr(instance, f.name, map_field)
+
+
+def _save_list_files(f, instance, uploads, workers, replaced):
+    list_field = getattr(instance, f.name)
+
+    def get_old(i):
+        try:
+            return list_field[i]
+        except IndexError:
+            return None
+
+    def set_new(i, file_data):
+        try:
+            list_field[i] = file_data
+        except IndexError:
+            list_field.append(file_data)
+    _save_container_files(f, instance, list(enumerate(uploads)), get_old,
+                          set_new, workers, replaced)
+    setattr(instance, f.name, list_field)
+
+
+def _save_file(f, instance, upload, workers, replaced):
+    field = getattr(instance, f.name)
+    if upload is None:
+        return
+
+    try:
+        upload.file.seek(0)
+    except AttributeError:
+        # file was already uploaded and not changed during edit.
+        # upload is already the gridfsproxy object we need.
+        upload.get()
+        setattr(instance, f.name, upload)
+        return
+
+    # write the new file first, the old one is deleted after the save
+    old_grid_id = field.grid_id
+    put_file(field, upload, f)
+    if old_grid_id:
+        replaced.add(field.db_alias, field.collection_name, old_grid_id)
+    setattr(instance, f.name, field)
+
+
+_file_savers = {
+    'file': _save_file,
+    'list': _save_list_files,
+    'map': _save_map_files,
+}
+
+
 def construct_instance(form, instance, fields=None, exclude=None):
     """
     Constructs and returns a document instance from the bound ``form``'s
@@ -78,79 +345,44 @@ def construct_instance(form, instance, fields=None, exclude=None):
     database.
     """
     cleaned_data = form.cleaned_data
-    file_field_list = []
 
     # check wether object is instantiated
     if isinstance(instance, type):
         instance = instance()
 
-    for f in instance._fields.values():
-        if isinstance(f, ObjectIdField):
-            continue
-        if f.name not in cleaned_data:
-            continue
-        if fields is not None and f.name not in fields:
-            continue
-        if exclude and f.name in exclude:
+    # use the plan compiled for the form class if it fits, dynamic
+    # documents and subclasses of the form's document need their own.
+    plan = getattr(getattr(form, '_meta', None), 'construct_plan', None)
+    if plan is None or not plan.matches(instance, fields, exclude):
+        plan = ConstructPlan(instance._fields, fields, exclude)
+
+    for name in plan.plain:
+        if name in cleaned_data:
+            setattr(instance, name, cleaned_data[name])
+
+    workers = _get_upload_workers(form)
+    # replaced files are deleted once the form saved the document. Forms
+    # that can't do that get them deleted right away.
+    replaced = getattr(form, '_replaced_files', None)
+    if replaced is None:
+        replaced = DeletionQueue()
+        delete_now = True
+    else:
+        delete_now = False
+    for name, kind in plan.files:
+        if name not in cleaned_data:
             continue
-        # Defer saving file-type fields until after the other fields, so a
-        # callable upload_to can use the values from other fields.
-        if isinstance(f, FileField) or \
-                (isinstance(f, (MapField, ListField)) and
-                 isinstance(f.field, FileField)):
-            file_field_list.append(f)
-        else:
-            setattr(instance, f.name, cleaned_data.get(f.name))
-
-    for f in file_field_list:
-        if isinstance(f, MapField):
-            map_field = getattr(instance, f.name)
-            uploads = cleaned_data[f.name]
-            for key, uploaded_file in uploads.items():
-                if uploaded_file is None:
-                    continue
-                file_data = map_field.get(key, None)
-                map_field[key] = _save_iterator_file(f, instance,
-                                                     uploaded_file, file_data)
-            setattr(instance, f.name, map_field)
-        elif isinstance(f, ListField):
-            list_field = getattr(instance, f.name)
-            uploads = cleaned_data[f.name]
-            for i, uploaded_file in enumerate(uploads):
-                if uploaded_file is None:
-                    continue
-                try:
-                    file_data = list_field[i]
-                except IndexError:
-                    file_data = None
-                file_obj = _save_iterator_file(f, instance,
-                                               uploaded_file, file_data)
-                try:
-                    list_field[i] = file_obj
-                except IndexError:
-                    list_field.append(file_obj)
-            setattr(instance, f.name, list_field)
-        else:
-            field = getattr(instance, f.name)
-            upload = cleaned_data[f.name]
-            if upload is None:
-                continue
-
-            try:
-                upload.file.seek(0)
-                # delete first to get the names right
-                if field.grid_id:
-                    field.delete()
-                filename = _get_unique_filename(upload.name, f.db_alias,
-                                                f.collection_name)
-                field.put(upload, content_type=upload.content_type,
-                          filename=filename)
-                setattr(instance, f.name, field)
-            except AttributeError:
-                # file was already uploaded and not changed during edit.
-                # upload is already the gridfsproxy object we need.
-                upload.get()
-                setattr(instance, f.name, upload)
+        try:
+            _file_savers[kind](instance._fields[name], instance,
+                               cleaned_data[name], workers, replaced)
+        except UPLOAD_ERRORS:
+            if not hasattr(form, '_update_errors'):
+                raise
+            form._update_errors({
+                name: [ugettext('The uploaded file could not be stored.')]
+            })
+    if delete_now:
+        replaced.flush()
 
     return instance
 
@@ -185,10 +417,12 @@ def save_instance(form, instance, fields=None, fail_message='saved',
         #    instance._data = data
         # else:
         instance.save()
+        if hasattr(form, 'delete_replaced_files'):
+            form.delete_replaced_files()
     return instance
 
 
-def document_to_dict(instance, fields=None, exclude=None):
+def document_to_dict(instance, fields=None, exclude=None, identity_map=None):
     """
     Returns a dict containing the data in ``instance`` suitable for passing as
     a Form's ``initial`` keyword argument.
@@ -199,6 +433,8 @@ def document_to_dict(instance, fields=None, exclude=None):
     ``exclude`` is an optional list of field names. If provided, the named
     fields will be excluded from the returned dict, even if they are listed in
     the ``fields`` argument.
+
+    Referenced documents are added to ``identity_map`` if it is given.
     """
     data = {}
     for f in instance._fields.values():
@@ -207,9 +443,55 @@ def document_to_dict(instance, fields=None, exclude=None):
         if exclude and f.name in exclude:
             continue
         data[f.name] = getattr(instance, f.name, '')
+        if identity_map is not None:
+            if isinstance(f, ReferenceField):
+                identity_map.add(data[f.name])
+            elif isinstance(f, ListField) and \
+                    isinstance(f.field, ReferenceField):
+                identity_map.add_many(data[f.name] or [])
     return data
 
 
+class FieldPlan(object):
+    """
+    The form fields a generator creates for the fields of a document. Each
+    form field is generated once, when it is first needed, and copied for
+    every form class that uses it.
+    """
+
+    def __init__(self, document):
+        self.document = document
+        self._formfields = {}
+
+    def get(self, field, field_generator):
+        try:
+            formfield = self._formfields[field.name]
+        except KeyError:
+            formfield = field_generator.generate(field)
+            self._formfields[field.name] = formfield
+        if formfield is None:
+            return None
+        return copy.deepcopy(formfield)
+
+
+# ("module.DocumentName", generator class) -> FieldPlan
+_field_plans = {}
+
+
+def _get_field_plan(document, generator_class):
+    """
+    Returns the FieldPlan of ``document`` for ``generator_class``. Plans
+    are keyed by the document's import path, so a redefined document class
+    replaces the plan of the old one.
+    """
+    key = ('%s.%s' % (document.__module__, document.__name__),
+           generator_class)
+    plan = _field_plans.get(key)
+    if plan is None or plan.document is not document:
+        plan = _field_plans[key] = FieldPlan(document)
+    return plan
+
+
 def fields_for_document(document, fields=None, exclude=None, widgets=None,
                         formfield_callback=None,
                         field_generator=_fieldgenerator):
@@ -224,7 +506,11 @@ def fields_for_document(document, fields=None, exclude=None, widgets=None,
     in the ``fields`` argument.
     """
     field_list = []
+    meta = get_meta_wrapper(document)
+    plan = None
     if isinstance(field_generator, type):
+        if not formfield_callback:
+            plan = _get_field_plan(document, field_generator)
         field_generator = field_generator()
 
     if formfield_callback and not isinstance(formfield_callback, Callable):
@@ -238,6 +524,8 @@ def fields_for_document(document, fields=None, exclude=None, widgets=None,
             continue
         if exclude and f.name in exclude:
             continue
+        # the lookup adds the attributes Django expects to the field
+        meta.get_field(name)
         if widgets and f.name in widgets:
             kwargs = {'widget': widgets[f.name]}
         else:
@@ -245,6 +533,8 @@ def fields_for_document(document, fields=None, exclude=None, widgets=None,
 
         if formfield_callback:
             formfield = formfield_callback(f, **kwargs)
+        elif plan is not None and not kwargs:
+            formfield = plan.get(f, field_generator)
         else:
             formfield = field_generator.generate(f, **kwargs)
 
@@ -270,17 +560,20 @@ class ModelFormOptions(object):
             self.document = getattr(options, 'model', None)
 
         self.model = self.document
-        meta = getattr(self.document, '_meta', {})
         # set up the document meta wrapper if document meta is a dict
-        if self.document is not None and \
-                not isinstance(meta, DocumentMetaWrapper):
-            self.document._meta = DocumentMetaWrapper(self.document)
+        if self.document is not None:
+            get_meta_wrapper(self.document)
         self.fields = getattr(options, 'fields', None)
         self.exclude = getattr(options, 'exclude', None)
         self.widgets = getattr(options, 'widgets', None)
         self.embedded_field = getattr(options, 'embedded_field_name', None)
         self.formfield_generator = getattr(options, 'formfield_generator',
                                            _fieldgenerator)
+        # threads saving the files of a list or map field
+        self.upload_workers = getattr(options, 'upload_workers', None)
+
+        # compiled by DocumentFormMetaclass for construct_instance
+        self.construct_plan = None
 
         self._dont_save = []
 
@@ -333,6 +626,8 @@ class DocumentFormMetaclass(DeclarativeFieldsMetaclass):
             # Override default model fields with any custom declared ones
             # (plus, include all the other declared fields).
             fields.update(new_class.declared_fields)
+            opts.construct_plan = ConstructPlan(opts.document._fields,
+                                                opts.fields, opts.exclude)
         else:
             fields = new_class.declared_fields
 
@@ -341,12 +636,20 @@ class DocumentFormMetaclass(DeclarativeFieldsMetaclass):
 
 
 class BaseDocumentForm(BaseForm):
+    # set by BaseDocumentFormSet, which validates uniqueness for all of
+    # its forms with one query per unique field.
+    _unique_validated_by_formset = False
 
     def __init__(self, data=None, files=None, auto_id='id_%s', prefix=None,
                  initial=None, error_class=ErrorList, label_suffix=':',
                  empty_permitted=False, instance=None):
 
         opts = self._meta
+        # documents loaded while this form is processed. Formsets share
+        # one map between all their forms.
+        self.identity_map = IdentityMap()
+        # files replaced by uploads, deleted after the document is saved
+        self._replaced_files = DeletionQueue()
 
         if instance is None:
             if opts.document is None:
@@ -356,7 +659,8 @@ class BaseDocumentForm(BaseForm):
             object_data = {}
         else:
             self.instance = instance
-            object_data = document_to_dict(instance, opts.fields, opts.exclude)
+            object_data = document_to_dict(instance, opts.fields, opts.exclude,
+                                           self.identity_map)
 
         # if initial was provided, it should override the values from instance
         if initial is not None:
@@ -369,6 +673,34 @@ class BaseDocumentForm(BaseForm):
         super(BaseDocumentForm, self).__init__(data, files, auto_id, prefix,
                                                object_data, error_class,
                                                label_suffix, empty_permitted)
+        self.use_identity_map(self.identity_map)
+
+        # callable defaults of the document are evaluated when they are
+        # needed, and only once for this form
+        for name, field in self.fields.items():
+            if name not in self.initial and \
+                    isinstance(field.initial, Callable):
+                self.initial[name] = LazyInitial(field.initial)
+
+    def use_identity_map(self, identity_map):
+        """
+        Makes the form and its reference fields use ``identity_map``. The
+        documents known to the current map are added to it.
+        """
+        if identity_map is not self.identity_map:
+            identity_map.update(self.identity_map)
+            self.identity_map = identity_map
+        for field in self.fields.values():
+            if isinstance(field, ReferenceFormField):
+                field.identity_map = identity_map
+
+    def delete_replaced_files(self):
+        """
+        Deletes the files that uploads to this form replaced. ``save()``
+        does this after saving the document. If you use
+        ``save(commit=False)``, call it after you saved the document.
+        """
+        self._replaced_files.flush()
 
     def _update_errors(self, message_dict):
         for k, v in list(message_dict.items()):
@@ -471,54 +803,90 @@ class BaseDocumentForm(BaseForm):
         finally:
             self.instance._fields_ordered = original_fields
 
-        # Validate uniqueness if needed.
-        if self._validate_unique:
+        # Validate uniqueness if needed. Forms in a formset leave this to
+        # the formset, which checks all of its forms at once.
+        if self._validate_unique and not self._unique_validated_by_formset:
             self.validate_unique()
 
+    def _get_unique_checks(self):
+        """
+        Returns a list of ``(field_name, lookups)`` tuples, one for every
+        unique field that is not excluded from validation. ``lookups`` is a
+        list of ``(field_name, value)`` tuples for the field itself and
+        every field in its ``unique_with``.
+        """
+        checks = []
+        exclude = self._get_validation_exclusions()
+        for f in self.instance._fields.values():
+            if f.unique and f.name not in exclude:
+                lookups = [(f.name, getattr(self.instance, f.name))]
+                for u_with in f.unique_with or []:
+                    lookups.append((u_with, getattr(self.instance, u_with)))
+                checks.append((f.name, lookups))
+        return checks
+
+    def _get_unique_error_message(self, field_name):
+        return _("%s with this %s already exists.") % (
+            str(capfirst(self.instance._meta.verbose_name)),
+            str(pretty_name(field_name))
+        )
+
+    def _probe_unique(self, checks):
+        """
+        Returns a document (as a dict with only ``_id`` and the checked
+        fields) violating any of the given unique checks or None.
+        """
+        document = self.instance.__class__
+        q = reduce(operator.or_,
+                   [_unique_check_q(document, l) for n, l in checks])
+        names = set(n for c in checks for n, v in c[1])
+        qs = document.objects.clone().no_dereference().filter(q)
+        # Exclude the current object from the query if we are editing
+        # an instance (as opposed to creating a new one)
+        if self.instance.pk is not None:
+            qs = qs.filter(pk__ne=self.instance.pk)
+        for raw in qs.only(*names).limit(1).as_pymongo():
+            return raw
+        return None
+
     def validate_unique(self):
         """
         Validates unique constrains on the document.
         unique_with is supported now.
+
+        All checks are combined into a single query that fetches at most one
+        document. The violated constraints are worked out from that
+        document, so only another query per violation is needed.
         """
         errors = []
-        exclude = self._get_validation_exclusions()
-        for f in self.instance._fields.values():
-            if f.unique and f.name not in exclude:
-                filter_kwargs = {
-                    f.name: getattr(self.instance, f.name),
-                    'q_obj': None,
-                }
-                if f.unique_with:
-                    for u_with in f.unique_with:
-                        u_with_field = self.instance._fields[u_with]
-                        u_with_attr = getattr(self.instance, u_with)
-                        # handling ListField(ReferenceField()) sucks big time
-                        # What we need to do is construct a Q object that
-                        # queries for the pk of every list entry and only
-                        # accepts lists with the same length as our list
-                        if isinstance(u_with_field, ListField) and \
-                                isinstance(u_with_field.field, ReferenceField):
-                            q_list = [Q(**{u_with: k.pk}) for k in u_with_attr]
-                            q = reduce(lambda x, y: x & y, q_list)
-                            size_key = '%s__size' % u_with
-                            q = q & Q(**{size_key: len(u_with_attr)})
-                            filter_kwargs['q_obj'] = q & filter_kwargs['q_obj']
-                        else:
-                            filter_kwargs[u_with] = u_with_attr
-                qs = self.instance.__class__.objects.clone()
-                qs = qs.no_dereference().filter(**filter_kwargs)
-                # Exclude the current object from the query if we are editing
-                # an instance (as opposed to creating a new one)
-                if self.instance.pk is not None:
-                    qs = qs.filter(pk__ne=self.instance.pk)
-                if qs.count() > 0:
-                    message = _("%s with this %s already exists.") % (
-                        str(capfirst(self.instance._meta.verbose_name)),
-                        str(pretty_name(f.name))
-                    )
-                    err_dict = {f.name: [message]}
-                    self._update_errors(err_dict)
-                    errors.append(err_dict)
+        document = self.instance.__class__
+        checks = self._get_unique_checks()
+        while checks:
+            raw = self._probe_unique(checks)
+            if raw is None:
+                break
+            violated = []
+            for check in checks:
+                names = [n for n, v in check[1]]
+                try:
+                    key = _unique_check_key(document, check[1])
+                except TypeError:
+                    continue
+                if key == _raw_unique_check_key(document, names, raw):
+                    violated.append(check)
+            if not violated:
+                # the document matched on the server but the values don't
+                # compare equal in python. Probe each check on its own.
+                violated = [c for c in checks if self._probe_unique([c])]
+                if not violated:
+                    break
+            for check in violated:
+                name = check[0]
+                err_dict = {name: [self._get_unique_error_message(name)]}
+                self._update_errors(err_dict)
+                errors.append(err_dict)
+            violated = set(c[0] for c in violated)
+            checks = [c for c in checks if c[0] not in violated]
 
         return errors
 
@@ -548,8 +916,57 @@ class DocumentForm(with_metaclass(DocumentFormMetaclass, BaseDocumentForm)):
     pass
 
 
+def _factory_cache_key(*parts):
+    """
+    Returns a key for the form class cache or None if one of the arguments
+    can't be hashed, in which case the class isn't cached.
+    """
+    key = tuple(tuple(p) if isinstance(p, list) else p for p in parts)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _get_cached_class(key, build):
+    if key is None:
+        return build()
+    cls = _form_class_cache.get(key)
+    if cls is None:
+        cls = build()
+        _form_class_cache.set(key, cls)
+    return cls
+
+
+def form_class_cache_stats():
+    """
+    Returns the hits, misses and size of the cache used by the form and
+    formset factories.
+    """
+    return _form_class_cache.stats()
+
+
+def clear_form_class_cache():
+    _form_class_cache.clear()
+
+
 def documentform_factory(document, form=DocumentForm, fields=None,
                          exclude=None, formfield_callback=None):
+    """
+    Returns a form class for ``document``. The generated classes are cached,
+    calling this again with the same arguments returns the same class.
+    """
+    generator = getattr(getattr(form, 'Meta', None), 'formfield_generator',
+                        None)
+    key = _factory_cache_key('form', document, form, generator, fields,
+                             exclude, formfield_callback)
+    return _get_cached_class(key, lambda: _documentform_factory(
+        document, form, fields, exclude, formfield_callback))
+
+
+def _documentform_factory(document, form, fields, exclude,
+                          formfield_callback):
     # Build up a list of attributes that the Meta object will have.
     attrs = {'document': document, 'model': document}
     if fields is not None:
@@ -566,10 +983,9 @@ def documentform_factory(document, form=DocumentForm, fields=None,
 
     # Give this new form class a reasonable name.
     if isinstance(document, type):
-        doc_inst = document()
+        class_name = document.__name__ + 'Form'
     else:
-        doc_inst = document
-    class_name = doc_inst.__class__.__name__ + 'Form'
+        class_name = document.__class__.__name__ + 'Form'
 
     # Class attributes for the new form class.
     form_class_attrs = {
@@ -655,6 +1071,7 @@ class EmbeddedDocumentForm(with_metaclass(DocumentFormMetaclass,
                 setattr(self.parent_document, self._meta.embedded_field,
                         self.instance)
                 self.parent_document.save()
+            self.delete_replaced_files()
         return self.instance
 
 
@@ -664,11 +1081,19 @@ class BaseDocumentFormSet(BaseFormSet):
     A ``FormSet`` for editing a queryset and/or adding new objects to it.
     """
 
+    # If True, save() writes all documents of a collection with one
+    # insert_many, one bulk_write and one delete_many. Document signals
+    # and custom save() or delete() methods are not called in that case.
+    bulk_save = False
+
     def __init__(self, data=None, files=None, auto_id='id_%s', prefix=None,
                  queryset=[], **kwargs):
         if not isinstance(queryset, (list, BaseQuerySet)):
             queryset = [queryset]
         self.queryset = queryset
+        # documents loaded while this formset is processed, shared by
+        # all of its forms
+        self.identity_map = IdentityMap()
         self.initial = self.construct_initial()
         defaults = {'data': data, 'files': files, 'auto_id': auto_id,
                     'prefix': prefix, 'initial': self.initial}
@@ -679,7 +1104,8 @@ class BaseDocumentFormSet(BaseFormSet):
         initial = []
         try:
             for d in self.get_queryset():
-                initial.append(document_to_dict(d))
+                initial.append(document_to_dict(
+                    d, identity_map=self.identity_map))
         except TypeError:
             pass
         return initial
@@ -703,35 +1129,328 @@ class BaseDocumentFormSet(BaseFormSet):
         Saves model instances for every form, adding and changing instances
         as necessary, and returns the list of instances.
         """
+        if commit and self.bulk_save and UpdateOne is not None:
+            return self._bulk_save()
+
         saved = []
+        replaced = DeletionQueue()
         for form in self.forms:
             if not form.has_changed() and form not in self.initial_forms:
                 continue
             obj = self.save_object(form)
             if form.cleaned_data.get("DELETE", False):
                 try:
-                    obj.delete()
+                    delete_document(obj)
                 except AttributeError:
                     # if it has no delete method it is an embedded object. We
                     # just don't add to the list and it's gone. Cool huh?
-                    continue
+                    pass
+                # saving it again would upsert the deleted document
+                continue
             if commit:
                 obj.save()
+                replaced.extend(form._replaced_files)
+                form._replaced_files.clear()
             saved.append(obj)
+        replaced.flush()
         return saved
 
-    def clean(self):
-        self.validate_unique()
+    def delete_replaced_files(self):
+        """
+        Deletes the files that uploads to the forms of this formset
+        replaced. Call it after saving the documents you got from
+        ``save(commit=False)``.
+        """
+        replaced = DeletionQueue()
+        for form in self.forms:
+            replaced.extend(form._replaced_files)
+            form._replaced_files.clear()
+        replaced.flush()
+
+    def _construct_form(self, i, **kwargs):
+        form = super(BaseDocumentFormSet, self)._construct_form(i, **kwargs)
+        form._unique_validated_by_formset = True
+        form.use_identity_map(self.identity_map)
+        return form
+
+    def full_clean(self):
+        if self.is_bound:
+            self.prefetch_references()
+        super(BaseDocumentFormSet, self).full_clean()
+        if not self.is_bound:
+            return
+        # the forms leave their unique checks to this, so it must not
+        # depend on subclasses calling clean() of this class
+        try:
+            self.validate_unique()
+        except DjangoValidationError as e:
+            self._non_form_errors.extend(e.error_list)
+
+    def prefetch_references(self):
+        """
+        Loads the documents referenced in the submitted data of all forms
+        with one query per queryset and hands them to the reference fields,
+        so they don't need to query for every form.
+        """
+        # queryset signature -> (queryset, submitted values, form fields)
+        groups = OrderedDict()
+        for form in self.forms:
+            for name, field in form.fields.items():
+                if not isinstance(field, ReferenceFormField) or \
+                        isinstance(field, DocumentMultipleChoiceField):
+                    continue
+                value = field.widget.value_from_datadict(
+                    form.data, form.files, form.add_prefix(name))
+                if value in EMPTY_VALUES:
+                    continue
+                queryset = field.queryset
+                signature = queryset_signature(queryset)
+                if signature not in groups:
+                    groups[signature] = (queryset, set(), [])
+                groups[signature][1].add(force_unicode(value))
+                groups[signature][2].append(field)
+
+        for queryset, values, fields in groups.values():
+            document = queryset._document
+            pk_field = document._fields[document._meta['id_field']]
+            # ids that aren't valid are looked up as missing
+            prefetched = dict((v, None) for v in values)
+            if is_unfiltered(queryset):
+                found, values = self.identity_map.get_many(document, values)
+                prefetched.update(found)
+            valid = []
+            for v in values:
+                try:
+                    valid.append(pk_field.to_mongo(pk_field.to_python(v)))
+                except (ValidationError, InvalidId, TypeError, ValueError):
+                    pass
+            if valid:
+                for obj in queryset.filter(pk__in=valid):
+                    prefetched[force_unicode(obj.pk)] = obj
+                    self.identity_map.add(obj)
+            for field in fields:
+                field._prefetched = prefetched
+
+    def _bulk_save(self):
+        """
+        Saves the documents of all forms with as few queries as possible.
+        Documents that could not be written are left out of the returned
+        list and the error is added to the non field errors of their form.
+        """
+        saved = []
+        # collection name -> (collection, inserts, updates, deletes)
+        writes = OrderedDict()
+        for form in self.forms:
+            if not form.has_changed() and form not in self.initial_forms:
+                continue
+            obj = self.save_object(form)
+            if not hasattr(obj, '_get_collection'):
+                # embedded documents can't be saved on their own
+                if not form.cleaned_data.get("DELETE", False):
+                    saved.append(obj)
+                continue
+            collection = obj._get_collection()
+            _, inserts, updates, deletes = writes.setdefault(
+                collection.full_name, (collection, [], [], []))
+            if form.cleaned_data.get("DELETE", False):
+                if obj.pk is not None:
+                    deletes.append((form, obj))
+            elif obj.pk is None or getattr(obj, '_created', False):
+                # setting the pk, even to None, clears _created
+                inserts.append((form, obj))
+                saved.append(obj)
+            else:
+                updates.append((form, obj))
+                saved.append(obj)
+
+        failed = set()
+
+        def add_errors(entries, exc):
+            if isinstance(exc, BulkWriteError):
+                errs = [(e['index'], e.get('errmsg', ''))
+                        for e in exc.details.get('writeErrors', [])]
+            else:
+                errs = [(i, str(exc)) for i in range(len(entries))]
+            for i, message in errs:
+                form, obj = entries[i]
+                form._update_errors({NON_FIELD_ERRORS: [
+                    ugettext("The %s could not be saved: %s") % (
+                        obj.__class__.__name__, message)
+                ]})
+                failed.add(id(obj))
+
+        for collection, inserts, updates, deletes in writes.values():
+            if inserts:
+                docs = [obj.to_mongo() for form, obj in inserts]
+                for doc in docs:
+                    if doc.get('_id') is None:
+                        doc.pop('_id', None)
+                try:
+                    collection.insert_many(docs, ordered=False)
+                except PyMongoError as e:
+                    add_errors(inserts, e)
+                # pymongo sets the _id on the documents it inserts
+                for doc, (form, obj) in zip(docs, inserts):
+                    if id(obj) not in failed:
+                        obj.pk = doc['_id']
+                        obj._created = False
+                        obj._clear_changed_fields()
+
+            # documents without changes don't need a write at all
+            ops = []
+            changed = []
+            for form, obj in updates:
+                sets, unsets = obj._delta()
+                update = {}
+                if sets:
+                    update['$set'] = sets
+                if unsets:
+                    update['$unset'] = unsets
+                if update:
+                    # upsert like Document.save() for documents with a
+                    # custom pk that were never stored
+                    ops.append(UpdateOne({'_id': _pk_to_mongo(obj)}, update,
+                                         upsert=True))
+                    changed.append((form, obj))
+            if ops:
+                try:
+                    collection.bulk_write(ops, ordered=False)
+                except PyMongoError as e:
+                    add_errors(changed, e)
+                for form, obj in changed:
+                    if id(obj) not in failed:
+                        obj._clear_changed_fields()
+
+            # documents of different classes can share a collection, and
+            # each class has its own delete rules
+            by_class = OrderedDict()
+            for form, obj in deletes:
+                by_class.setdefault(obj.__class__, []).append((form, obj))
+            for document, entries in by_class.items():
+                try:
+                    delete_documents(document, [obj for form, obj in entries])
+                except (PyMongoError, OperationError) as e:
+                    add_errors(entries, e)
+
+            # bulk writes send no signals to invalidate cached choices
+            if inserts or changed or deletes:
+                choicecache.invalidate(
+                    (inserts or changed or deletes)[0][1].__class__)
+
+        replaced = DeletionQueue()
+        for collection, inserts, updates, deletes in writes.values():
+            for form, obj in itertools.chain(inserts, updates):
+                if id(obj) not in failed:
+                    replaced.extend(form._replaced_files)
+                    form._replaced_files.clear()
+        replaced.flush()
+
+        return [obj for obj in saved if id(obj) not in failed]
 
     def validate_unique(self):
+        """
+        Validates the unique constraints of all forms at once. Values that
+        are duplicated between the forms of this formset are found in
+        memory, the database is queried once per unique field.
+        """
         errors = []
+        checks = OrderedDict()
         for form in self.forms:
-            if not hasattr(form, 'cleaned_data'):
+            if not form.is_valid():
                 continue
-            errors += form.validate_unique()
+            if form.cleaned_data.get('DELETE', False):
+                continue
+            # unchanged extra forms are not saved
+            if form in self.extra_forms and not form.has_changed():
+                continue
+            document = form.instance.__class__
+            for name, lookups in form._get_unique_checks():
+                # like Django, empty values are never duplicates
+                if any(value in EMPTY_VALUES for n, value in lookups):
+                    continue
+                checks.setdefault((document, name), []).append((form, lookups))
+
+        for (document, name), form_checks in checks.items():
+            errors += self._validate_unique_field(document, name, form_checks)
 
         if errors:
-            raise ValidationError(errors)
+            raise DjangoValidationError(errors)
+
+    def _validate_unique_field(self, document, name, form_checks):
+        errors = []
+        failed = set()
+
+        def add_error(form, message, formset_message=None):
+            form._update_errors({name: [message]})
+            errors.append(formset_message or message)
+            failed.add(form)
+
+        # find duplicates within this formset
+        names = [n for n, v in form_checks[0][1]]
+        keyed_forms = {}
+        unkeyed_forms = []
+        for form, lookups in form_checks:
+            try:
+                key = _unique_check_key(document, lookups)
+            except TypeError:
+                unkeyed_forms.append(form)
+                continue
+            if key in keyed_forms:
+                add_error(form, self.get_form_error(),
+                          self.get_unique_error_message(names))
+                continue
+            keyed_forms[key] = form
+
+        pending = [(f, l) for f, l in form_checks if f not in failed]
+        if not pending:
+            return errors
+
+        # one query for all forms that are left
+        q_list = []
+        for form, lookups in pending:
+            q = _unique_check_q(document, lookups)
+            if form.instance.pk is not None:
+                q = q & Q(pk__ne=form.instance.pk)
+            q_list.append(q)
+        # only() drops _id from as_pymongo() unless the pk is asked for
+        qs = document.objects.clone().no_dereference()
+        qs = qs.filter(reduce(operator.or_, q_list))
+        qs = qs.only(document._meta['id_field'], *names)
+
+        unmatched = False
+        for raw in qs.as_pymongo():
+            form = keyed_forms.get(_raw_unique_check_key(document, names, raw))
+            if form is None:
+                unmatched = True
+            elif form not in failed and (
+                    form.instance.pk is None or
+                    _pk_to_mongo(form.instance) != raw.get('_id')):
+                add_error(form, form._get_unique_error_message(name))
+
+        # a document matched on the server but not in python (e.g. because
+        # of lossy type conversions). Fall back to checking each form.
+        if unmatched or unkeyed_forms:
+            for form, lookups in pending:
+                if form in failed:
+                    continue
+                qs = document.objects.clone().no_dereference()
+                qs = qs.filter(_unique_check_q(document, lookups))
+                if form.instance.pk is not None:
+                    qs = qs.filter(pk__ne=form.instance.pk)
+                if qs.count() > 0:
+                    add_error(form, form._get_unique_error_message(name))
+
+        return errors
+
+    def get_unique_error_message(self, unique_check):
+        if len(unique_check) == 1:
+            return ugettext("Please correct the duplicate data for "
+                            "%(field)s.") % {"field": unique_check[0]}
+        else:
+            return ugettext("Please correct the duplicate data for "
+                            "%(field)s, which must be unique.") % {
+                "field": get_text_list(unique_check, ugettext("and")),
+            }
 
     def get_date_error_message(self, date_check):
         return ugettext("Please correct the duplicate data for %(field_name)s "
@@ -754,9 +1473,21 @@ def documentformset_factory(document, form=DocumentForm,
     """
     Returns a FormSet class for the given Django model class.
     """
-    form = documentform_factory(document, form=form, fields=fields,
-                                exclude=exclude,
-                                formfield_callback=formfield_callback)
+    key = _factory_cache_key('formset', document, form, formfield_callback,
+                             formset, extra, can_delete, can_order, max_num,
+                             fields, exclude)
+
+    def build():
+        form_class = documentform_factory(
+            document, form=form, fields=fields, exclude=exclude,
+            formfield_callback=formfield_callback)
+        return _documentformset_factory(document, form_class, formset, extra,
+                                        can_delete, can_order, max_num)
+    return _get_cached_class(key, build)
+
+
+def _documentformset_factory(document, form, formset, extra, can_delete,
+                             can_order, max_num):
     FormSet = formset_factory(form, formset, extra=extra, max_num=max_num,
                               can_order=can_order, can_delete=can_delete)
     FormSet.model = document
@@ -803,9 +1534,11 @@ class BaseInlineDocumentFormSet(BaseDocumentFormSet):
             # form._meta.fields.append(self.fk.name)
 
     def get_unique_error_message(self, unique_check):
-        unique_check = [
-            field for field in unique_check if field != self.fk.name
-        ]
+        fk = getattr(self, 'fk', None)
+        if fk is not None:
+            unique_check = [
+                field for field in unique_check if field != fk.name
+            ]
         return super(BaseInlineDocumentFormSet, self).get_unique_error_message(
             unique_check
         )
@@ -911,6 +1644,7 @@ class EmbeddedDocumentFormSet(BaseDocumentFormSet):
                 setattr(
                     self.parent_document, self.form._meta.embedded_field, objs)
             self.parent_document.save()
+            self.delete_replaced_files()
 
         return objs
 
@@ -971,20 +1705,21 @@ def embeddedformset_factory(document, parent_document,
     You must provide ``fk_name`` if ``model`` has more than one ``ForeignKey``
     to ``parent_model``.
     """
-    emb_field = _get_embedded_field(parent_document, document, emb_name=embedded_name)
-    if isinstance(emb_field, EmbeddedDocumentField):
-        max_num = 1
-    kwargs = {
-        'form': form,
-        'formfield_callback': formfield_callback,
-        'formset': formset,
-        'extra': extra,
-        'can_delete': can_delete,
-        'can_order': can_order,
-        'fields': fields,
-        'exclude': exclude,
-        'max_num': max_num,
-    }
-    FormSet = documentformset_factory(document, **kwargs)
-    FormSet.form._meta.embedded_field = emb_field.name
-    return FormSet
+    key = _factory_cache_key('embeddedformset', document, parent_document,
+                             form, formset, embedded_name, fields, exclude,
+                             extra, can_order, can_delete, max_num,
+                             formfield_callback)
+
+    def build():
+        emb_field = _get_embedded_field(parent_document, document,
+                                        emb_name=embedded_name)
+        num = 1 if isinstance(emb_field, EmbeddedDocumentField) else max_num
+        # the form class gets its own embedded field, so it must not be
+        # shared with other formsets
+        form_class = _documentform_factory(document, form, fields, exclude,
+                                           formfield_callback)
+        FormSet = _documentformset_factory(document, form_class, formset,
+                                           extra, can_delete, can_order, num)
+        FormSet.form._meta.embedded_field = emb_field.name
+        return FormSet
+    return _get_cached_class(key, build)
@@ -4,8 +4,6 @@
 Based on django mongotools (https://github.com/wpjunior/django-mongotools) by
 Wilson Júnior (wilsonpjunior@gmail.com).
 """
-import collections
-
 from django import forms
 from django.core.validators import EMPTY_VALUES, RegexValidator
 try:
@@ -16,6 +14,7 @@ except ImportError:
     except ImportError:
         from django.forms.util import smart_unicode
 from django.utils.text import capfirst
+from django.utils import six
 
 from mongoengine import (ReferenceField as MongoReferenceField,
                          EmbeddedDocumentField as MongoEmbeddedDocumentField,
@@ -31,6 +30,9 @@ from mongodbforms.documentoptions import create_verbose_name
 
 BLANK_CHOICE_DASH = [("", "---------")]
 
+# (generator class, mongoengine field class) -> handler or None
+_handler_cache = {}
+
 
 class MongoFormFieldGenerator(object):
     """This class generates Django form-fields for mongoengine-fields."""
@@ -70,9 +72,62 @@ class MongoFormFieldGenerator(object):
     }
     
     def __init__(self, field_overrides={}, widget_overrides={}):
+        # copy the maps, the overrides only apply to this instance
+        self.form_field_map = dict(self.form_field_map)
         self.form_field_map.update(field_overrides)
+        self.widget_override_map = dict(self.widget_override_map)
         self.widget_override_map.update(widget_overrides)
 
+    @classmethod
+    def register_generator(cls, field_class, handler):
+        """Registers a generator for a mongoengine field class and its
+        subclasses. ``handler`` is either the name of a method of the
+        generator or a function taking the generator, the field and the
+        keyword arguments for the form field.
+
+        Handlers registered on a generator class are used by its subclasses
+        as well.
+        """
+        if '_registry' not in cls.__dict__:
+            cls._registry = {}
+        cls._registry[field_class] = handler
+        _handler_cache.clear()
+
+    @classmethod
+    def _find_handler(cls, field_class):
+        for gen_cls in cls.__mro__:
+            registry = gen_cls.__dict__.get('_registry', {})
+            if field_class in registry:
+                handler = registry[field_class]
+                if isinstance(handler, six.string_types):
+                    handler = getattr(cls, handler)
+                return handler
+
+        cls_name = field_class.__name__.lower()
+        handler = getattr(cls, 'generate_%s' % cls_name, None)
+        if handler is None and cls_name in cls.generator_map:
+            handler = getattr(cls, cls.generator_map[cls_name])
+        return handler
+
+    @classmethod
+    def get_handler(cls, field_class):
+        """Returns the generator for ``field_class``: the first handler that
+        is registered or named after (lowercase ``generate_<classname>``) a
+        class in the field class' MRO. The result is cached.
+        """
+        key = (cls, field_class)
+        try:
+            return _handler_cache[key]
+        except KeyError:
+            pass
+        handler = None
+        for klass in field_class.__mro__:
+            handler = cls._find_handler(klass)
+            if handler is not None:
+                break
+        _handler_cache[key] = handler
+        return handler
+
     def generate(self, field, **kwargs):
         """Tries to lookup a matching formfield generator (lowercase
         field-classname) and raises a NotImplementedError of no generator
@@ -83,24 +138,12 @@ class MongoFormFieldGenerator(object):
         # to handle then a simple field
         if isinstance(field, MongoEmbeddedDocumentField):
             return
-        
-        attr_name = 'generate_%s' % field.__class__.__name__.lower()
-        if hasattr(self, attr_name):
-            return getattr(self, attr_name)(field, **kwargs)
 
-        for cls in field.__class__.__bases__:
-            cls_name = cls.__name__.lower()
-            
-            attr_name = 'generate_%s' % cls_name
-            if hasattr(self, attr_name):
-                return getattr(self, attr_name)(field, **kwargs)
-
-            if cls_name in self.form_field_map:
-                attr = self.generator_map.get(cls_name)
-                return getattr(self, attr)(field, **kwargs)
-                
-        raise NotImplementedError('%s is not supported by MongoForm' %
-                                  field.__class__.__name__)
+        handler = self.get_handler(field.__class__)
+        if handler is None:
+            raise NotImplementedError('%s is not supported by MongoForm' %
+                                      field.__class__.__name__)
+        return handler(self, field, **kwargs)
 
     def get_field_choices(self, field, include_blank=True,
                           blank_choice=BLANK_CHOICE_DASH):
@@ -140,13 +183,9 @@ class MongoFormFieldGenerator(object):
             f = field.field
         else:
             f = field
-        d = {}
-        if isinstance(f.default, collections.Callable):
-            d['initial'] = field.default()
-            d['show_hidden_initial'] = True
-            return f.default()
-        else:
-            d['initial'] = field.default
+        # Callable defaults are returned as they are. Django calls them
+        # when the initial value is needed and BaseDocumentForm makes sure
+        # that happens at most once per form.
         return f.default
         
     def check_widget(self, map_key):
@@ -27,28 +27,84 @@ from django.utils.translation import ugettext_lazy as _
 from django.forms.util import ErrorList
 from django.core.exceptions import ValidationError
 
+try:
+    from mongoengine.base import ValidationError as MongoValidationError
+except ImportError:
+    from mongoengine.errors import ValidationError as MongoValidationError
+
 try:  # objectid was moved into bson in pymongo 1.9
     from bson.errors import InvalidId
 except ImportError:
     from pymongo.errors import InvalidId
     
 from mongodbforms.widgets import ListWidget, MapWidget, HiddenMapWidget
+from mongodbforms import choicecache
+from mongodbforms.identitymap import is_unfiltered
 
 
 class MongoChoiceIterator(object):
     def __init__(self, field):
         self.field = field
         self.queryset = field.queryset
+        self._len = None
+
+    def _get_queryset(self):
+        qs = self.queryset
+        # the pk is always part of the projection
+        if self.field.label_fields is not None:
+            qs = qs.only(*self.field.label_fields)
+        if self.field.batch_size:
+            qs = qs.batch_size(self.field.batch_size)
+        # don't keep every document around while rendering the choices
+        if hasattr(qs, 'no_cache'):
+            qs = qs.no_cache()
+        return qs
 
     def __iter__(self):
         if self.field.empty_label is not None:
             yield ("", self.field.empty_label)
 
-        for obj in self.queryset.all():
+        if self.field.choice_cache_timeout:
+            choices = choicecache.get_choices(
+                self.field, self.queryset,
+                lambda: (self.choice(obj) for obj in self._get_queryset())
+            )
+            self._len = len(choices)
+            for choice in choices:
+                yield choice
+            return
+
+        count = 0
+        for obj in self._get_queryset():
+            count += 1
+            yield self.choice(obj)
+        self._len = count
+
+    def for_values(self, values):
+        """
+        Returns the choices for the given values only. Used by widgets
+        that don't render all documents of the queryset.
+        """
+        if self.field.empty_label is not None:
+            yield ("", self.field.empty_label)
+
+        pks = [self.field.prepare_value(v) for v in values
+               if v not in EMPTY_VALUES]
+        if not pks:
+            return
+        try:
+            objs = list(self._get_queryset().filter(pk__in=pks))
+        except (ValidationError, MongoValidationError, InvalidId):
+            # submitted data that isn't a valid pk doesn't get rendered
+            return
+        for obj in objs:
             yield self.choice(obj)
 
     def __len__(self):
-        return len(self.queryset)
+        if self._len is None:
+            # count() ignores a slice of the queryset by default
+            self._len = self.queryset.count(with_limit_and_skip=True)
+        return self._len
 
     def choice(self, obj):
         return (self.field.prepare_value(obj),
@@ -89,7 +145,34 @@ class ReferenceField(forms.ChoiceField):
     Reference field for mongo forms. Inspired by
     `django.forms.models.ModelChoiceField`.
     """
+    # Fields needed by label_from_instance. If set, only these fields (and
+    # the pk) are loaded to render the choices.
+    label_fields = None
+    # Number of documents fetched per round trip while rendering the choices.
+    batch_size = None
+    # If set, the choices are cached for this many seconds. See
+    # mongodbforms.choicecache.
+    choice_cache_timeout = None
+    # Part of the cache key. Set it to tell fields apart whose labels differ
+    # in ways the cache can't see, like a label_from_instance set to
+    # different lambdas defined on the same line.
+    choice_cache_key = None
+
+    # documents keyed by their pk as text, set by BaseDocumentFormSet.
+    # None marks a pk that doesn't exist in the queryset.
+    _prefetched = None
+    # set by BaseDocumentForm to reuse documents loaded by other fields
+    identity_map = None
+
     def __init__(self, queryset, empty_label="---------", *args, **kwargs):
+        if 'label_fields' in kwargs:
+            self.label_fields = kwargs.pop('label_fields')
+        if 'batch_size' in kwargs:
+            self.batch_size = kwargs.pop('batch_size')
+        if 'choice_cache_timeout' in kwargs:
+            self.choice_cache_timeout = kwargs.pop('choice_cache_timeout')
+        if 'choice_cache_key' in kwargs:
+            self.choice_cache_key = kwargs.pop('choice_cache_key')
         forms.Field.__init__(self, *args, **kwargs)
         self.empty_label = empty_label
         self.queryset = queryset
@@ -99,6 +182,8 @@ class ReferenceField(forms.ChoiceField):
     
     def _set_queryset(self, queryset):
         self._queryset = queryset
+        if self.choice_cache_timeout:
+            choicecache.watch(queryset._document)
         self.widget.choices = self.choices
     queryset = property(_get_queryset, _set_queryset)
 
@@ -121,6 +206,11 @@ class ReferenceField(forms.ChoiceField):
         """
         return smart_unicode(obj)
 
+    def validate(self, value):
+        # Skip ChoiceField.validate, it iterates all choices to find the
+        # value. clean() looks the document up in the queryset anyway.
+        forms.Field.validate(self, value)
+
     def clean(self, value):
         # Check for empty values.
         if value in EMPTY_VALUES:
@@ -130,13 +220,31 @@ class ReferenceField(forms.ChoiceField):
                 return None
 
         oid = super(ReferenceField, self).clean(value)
-        
+
+        # the formset may have loaded the documents of all its forms already
+        if self._prefetched is not None and oid in self._prefetched:
+            obj = self._prefetched[oid]
+            if obj is None:
+                raise forms.ValidationError(
+                    self.error_messages['invalid_choice'] % {'value': value}
+                )
+            return obj
+
+        qs = self.queryset
+        use_map = self.identity_map is not None and is_unfiltered(qs)
+        if use_map:
+            obj = self.identity_map.get(qs._document, oid)
+            if obj is not None:
+                return obj
+
         try:
-            obj = self.queryset.get(pk=oid)
-        except (TypeError, InvalidId, self.queryset._document.DoesNotExist):
+            obj = qs.get(pk=oid)
+        except (TypeError, InvalidId, qs._document.DoesNotExist):
             raise forms.ValidationError(
                 self.error_messages['invalid_choice'] % {'value': value}
             )
+        if self.identity_map is not None:
+            self.identity_map.add(obj)
         return obj
     
     def __deepcopy__(self, memo):
@@ -171,22 +279,30 @@ class DocumentMultipleChoiceField(ReferenceField):
             raise forms.ValidationError(self.error_messages['list'])
         
         qs = self.queryset
+        missing = value
+        objs = {}
+        if self.identity_map is not None and is_unfiltered(qs):
+            objs, missing = self.identity_map.get_many(qs._document, value)
         try:
-            qs = qs.filter(pk__in=value)
-        except ValidationError:
+            if missing:
+                for o in qs.filter(pk__in=missing):
+                    objs[force_unicode(o.pk)] = o
+                    if self.identity_map is not None:
+                        self.identity_map.add(o)
+        except (ValidationError, MongoValidationError, InvalidId):
             raise forms.ValidationError(
                 self.error_messages['invalid_pk_value'] % str(value)
             )
-        pks = set([force_unicode(getattr(o, 'pk')) for o in qs])
         for val in value:
-            if force_unicode(val) not in pks:
+            if force_unicode(val) not in objs:
                 raise forms.ValidationError(
                     self.error_messages['invalid_choice'] % val
                 )
         # Since this overrides the inherited ModelChoiceField.clean
         # we run custom validators here
         self.run_validators(value)
-        return list(qs)
+        # return the documents in the order they were submitted
+        return [objs[force_unicode(val)] for val in value]
 
     def prepare_value(self, value):
         if hasattr(value, '__iter__') and not hasattr(value, '_meta'):
@@ -259,6 +375,11 @@ class ListField(forms.Field):
         self.run_validators(clean_data)
         return clean_data
 
+    def __deepcopy__(self, memo):
+        result = super(ListField, self).__deepcopy__(memo)
+        result.contained_field = copy.deepcopy(self.contained_field, memo)
+        return result
+
     def _has_changed(self, initial, data):
         if initial is None:
             initial = ['' for x in range(0, len(data))]
@@ -386,6 +507,12 @@ class MapField(forms.Field):
         self.run_validators(clean_data)
         return clean_data
 
+    def __deepcopy__(self, memo):
+        result = super(MapField, self).__deepcopy__(memo)
+        result.contained_field = copy.deepcopy(self.contained_field, memo)
+        result.key_validators = self.key_validators[:]
+        return result
+
     def _has_changed(self, initial, data):
         for k, v in data.items():
             if initial is None:
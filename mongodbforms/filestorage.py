@@ -0,0 +1,618 @@
+"""
+Writes uploaded files to GridFS for the file fields of document forms.
+
+The name a file is stored under is chosen by a filename strategy. A
+strategy can be set for a field with its ``filename_strategy`` attribute or
+for all fields with the ``MONGODBFORMS_FILENAME_STRATEGY`` setting, either
+as a ``FilenameStrategy`` class or instance or as its dotted path. The
+default is ``SuffixFilenameStrategy``.
+
+If ``MONGODBFORMS_GRIDFS_UNIQUE_FILENAMES`` is True a unique index on
+``filename`` is created for every GridFS collection written to, and a
+write that loses a race for a name is retried with a new name.
+
+Fields with a true ``deduplicate`` attribute, or all fields if
+``MONGODBFORMS_GRIDFS_DEDUPLICATE`` is True, store each content only once.
+The SHA-256 digest of a file is kept in its ``sha256`` key and the number
+of proxies pointing at it in ``refcount``. Uploads are hashed while they
+are written, and a new file whose digest is already known is dropped for
+the stored one. ``delete_file`` and ``delete_files`` only remove a file
+once its last reference is gone. Deduplicated files must only be deleted
+with them: mongoengine's ``GridFSProxy.delete`` ignores ``refcount`` and
+removes a file other documents may still use. ``Document.delete`` calls it
+for every file field, so documents with deduplicated files have to be
+deleted with ``delete_document``.
+
+Uploads are streamed into GridFS chunk by chunk, or taken over as they are
+if ``GridFSUploadHandler`` already wrote them to the field's GridFS.
+Proxies that change files in their ``put`` method, like the resizing and
+thumbnails of ``ImageGridFsProxy``, are written with ``put`` instead and
+are not deduplicated, as the stored file differs from the upload. The
+chunk size is taken from the field's ``chunk_size`` attribute or the
+``MONGODBFORMS_GRIDFS_CHUNK_SIZE`` setting, and defaults to the one of
+GridFS.
+
+Files replaced by new uploads are collected in a ``DeletionQueue`` and
+deleted in batches once the document was saved.
+"""
+import hashlib
+import os
+from collections import Counter, OrderedDict
+import re
+import threading
+import uuid
+import warnings
+
+from django.conf import settings
+from django.utils import six
+from django.utils.text import get_valid_filename
+
+from mongoengine import signals
+from mongoengine.connection import get_db
+from mongoengine.fields import GridFSProxy, FileField
+from gridfs import GridFS
+from gridfs.errors import FileExists
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from mongodbforms.util import import_by_path
+from mongodbforms.uploadhandler import GridFSUploadedFile
+
+# how often a write is retried if its filename was taken in between
+MAX_ATTEMPTS = 5
+
+# bytes read at a time from files that have no chunks() method
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+class FilenameStrategy(object):
+    """
+    Chooses the filename an upload is stored under in GridFS.
+    """
+
+    def get_filename(self, name, upload, files):
+        """
+        Returns the filename for ``upload``. ``name`` is the name of the
+        uploaded file and ``files`` the ``<collection>.files`` collection
+        of the GridFS the file is written to.
+        """
+        raise NotImplementedError
+
+    def get_filenames(self, uploads, files):
+        """
+        Returns the filenames for a list of ``(name, upload)`` pairs that
+        are stored together. The names are chosen one after the other, and
+        a name chosen for an earlier upload gets a ``_<n>`` suffix.
+        """
+        chosen = set()
+        filenames = []
+        for name, upload in uploads:
+            filename = _unused(self.get_filename(name, upload, files), chosen)
+            chosen.add(filename)
+            filenames.append(filename)
+        return filenames
+
+
+def _unused(filename, chosen):
+    file_root, file_ext = os.path.splitext(filename)
+    suffix = 0
+    while filename in chosen:
+        suffix += 1
+        filename = '%s_%s%s' % (file_root, suffix, file_ext)
+    return filename
+
+
+class SuffixFilenameStrategy(FilenameStrategy):
+    """
+    Keeps the name of the upload if it is free and adds ``_<n>`` to it
+    otherwise, with ``n`` one higher than the highest suffix in use. All
+    names in use are found with one anchored regex query, which can use
+    GridFS's index on ``filename``.
+    """
+
+    def _highest_suffix(self, name, files):
+        """
+        Returns None if ``name`` is free, otherwise the highest suffix in
+        use for it or 0.
+        """
+        file_root, file_ext = os.path.splitext(get_valid_filename(name))
+        pattern = re.compile('^%s(?:_([0-9]+))?%s$' % (re.escape(file_root),
+                                                       re.escape(file_ext)))
+        taken = False
+        suffix = 0
+        cursor = files.find({'filename': {'$in': [name, pattern]}},
+                            {'filename': True, '_id': False})
+        for doc in cursor:
+            if doc['filename'] == name:
+                taken = True
+            match = pattern.match(doc['filename'])
+            if match and match.group(1):
+                suffix = max(suffix, int(match.group(1)))
+        return suffix if taken else None
+
+    def _with_suffix(self, name, suffix):
+        file_root, file_ext = os.path.splitext(get_valid_filename(name))
+        # file_ext includes the dot.
+        return '%s_%s%s' % (file_root, suffix, file_ext)
+
+    def get_filename(self, name, upload, files):
+        suffix = self._highest_suffix(name, files)
+        if suffix is None:
+            return name
+        return self._with_suffix(name, suffix + 1)
+
+    def get_filenames(self, uploads, files):
+        """
+        Like ``get_filename`` for each upload, but uploads with the same
+        name continue counting the suffix up.
+        """
+        highest = {}
+        chosen = set()
+        filenames = []
+        for name, upload in uploads:
+            if name not in highest:
+                highest[name] = self._highest_suffix(name, files)
+            suffix = highest[name]
+            if suffix is None:
+                filename = name
+                highest[name] = 0
+            else:
+                filename = self._with_suffix(name, suffix + 1)
+                highest[name] = suffix + 1
+            filename = _unused(filename, chosen)
+            chosen.add(filename)
+            filenames.append(filename)
+        return filenames
+
+
+class UUIDFilenameStrategy(FilenameStrategy):
+    """
+    Names files with a random UUID and the extension of the upload. No
+    query is needed.
+    """
+
+    def get_filename(self, name, upload, files):
+        file_ext = os.path.splitext(get_valid_filename(name))[1]
+        return '%s%s' % (uuid.uuid4().hex, file_ext)
+
+
+def _hash_upload(upload):
+    """Returns the SHA-256 hex digest of ``upload`` and its length."""
+    digest = hashlib.sha256()
+    length = 0
+    upload.seek(0)
+    if hasattr(upload, 'chunks'):
+        chunks = upload.chunks()
+    else:
+        chunks = iter(lambda: upload.read(DEFAULT_CHUNK_SIZE), b'')
+    for chunk in chunks:
+        digest.update(chunk)
+        length += len(chunk)
+    upload.seek(0)
+    return digest.hexdigest(), length
+
+
+class ContentHashFilenameStrategy(SuffixFilenameStrategy):
+    """
+    Names files with the SHA-256 digest of their content and the extension
+    of the upload. Repeated uploads of the same content get a suffix.
+    """
+
+    def _hash_name(self, name, upload):
+        file_ext = os.path.splitext(get_valid_filename(name))[1]
+        return '%s%s' % (_hash_upload(upload)[0], file_ext)
+
+    def get_filename(self, name, upload, files):
+        return super(ContentHashFilenameStrategy, self).get_filename(
+            self._hash_name(name, upload), upload, files)
+
+    def get_filenames(self, uploads, files):
+        uploads = [(self._hash_name(name, upload), upload)
+                   for name, upload in uploads]
+        return super(ContentHashFilenameStrategy, self).get_filenames(
+            uploads, files)
+
+
+_strategies = {}
+_default_strategy = SuffixFilenameStrategy()
+
+
+def get_filename_strategy(field):
+    """
+    Returns the filename strategy for the mongoengine file field ``field``.
+    """
+    strategy = getattr(field, 'filename_strategy', None)
+    if strategy is None:
+        strategy = getattr(settings, 'MONGODBFORMS_FILENAME_STRATEGY', None)
+    if strategy is None:
+        return _default_strategy
+    if isinstance(strategy, FilenameStrategy):
+        return strategy
+    try:
+        return _strategies[strategy]
+    except KeyError:
+        pass
+    if isinstance(strategy, six.string_types):
+        strategy_class = import_by_path(strategy)
+    else:
+        strategy_class = strategy
+    _strategies[strategy] = strategy_class()
+    return _strategies[strategy]
+
+
+_indexes = set()
+_index_lock = threading.Lock()
+
+
+def _ensure_index(files, key, **kwargs):
+    """Creates an index on ``files`` once per process."""
+    index = (files.full_name, key)
+    if index in _indexes:
+        return
+    with _index_lock:
+        if index in _indexes:
+            return
+        try:
+            files.create_index(key, **kwargs)
+        except OperationFailure as e:
+            warnings.warn("Could not create an index on %s for %s: %s" %
+                          (key, files.full_name, e))
+        _indexes.add(index)
+
+
+def deduplicates(field):
+    deduplicate = getattr(field, 'deduplicate', None)
+    if deduplicate is None:
+        deduplicate = getattr(settings, 'MONGODBFORMS_GRIDFS_DEDUPLICATE',
+                              False)
+    return deduplicate
+
+
+def _find_duplicate(files, sha256, length, grid_id=None):
+    """
+    Returns the id of a stored file other than ``grid_id`` with the given
+    digest and length and takes a reference to it, or None if there is no
+    such file.
+    """
+    _ensure_index(files, 'sha256', sparse=True)
+    doc = files.find_one_and_update(
+        {'sha256': sha256, 'length': length, '_id': {'$ne': grid_id}},
+        {'$inc': {'refcount': 1}}, projection={'_id': True})
+    return doc['_id'] if doc is not None else None
+
+
+def _deduplicate(proxy, files, field, sha256, length):
+    """
+    Replaces the file ``proxy`` was just written to by a stored file with
+    the same content if there is one. Otherwise the digest is recorded on
+    the new file.
+    """
+    duplicate = _find_duplicate(files, sha256, length, proxy.grid_id)
+    if duplicate is None:
+        files.update_one({'_id': proxy.grid_id}, {'$set': {'sha256': sha256}})
+        return
+    GridFS(files.database, field.collection_name).delete(proxy.grid_id)
+    proxy.grid_id = duplicate
+    proxy.gridout = None
+    proxy._mark_as_changed()
+
+
+def get_chunk_size(field):
+    chunk_size = getattr(field, 'chunk_size', None)
+    if chunk_size is None:
+        chunk_size = getattr(settings, 'MONGODBFORMS_GRIDFS_CHUNK_SIZE', None)
+    return chunk_size
+
+
+def _iter_chunks(upload, chunk_size):
+    if hasattr(upload, 'chunks'):
+        if chunk_size is None:
+            return upload.chunks()
+        return upload.chunks(chunk_size)
+    return iter(lambda: upload.read(chunk_size or DEFAULT_CHUNK_SIZE), b'')
+
+
+def _stream_file(proxy, upload, chunk_size, digest=None, **kwargs):
+    """
+    Writes ``upload`` to a new file in the GridFS of ``proxy`` one chunk
+    at a time and points ``proxy`` at it once it is complete. The chunks
+    are also fed to the hash object ``digest`` if one is given. Returns
+    the length of the file.
+    """
+    if chunk_size is not None:
+        kwargs['chunk_size'] = chunk_size
+    grid_in = proxy.fs.new_file(**kwargs)
+    try:
+        for chunk in _iter_chunks(upload, chunk_size):
+            grid_in.write(chunk)
+            if digest is not None:
+                digest.update(chunk)
+        grid_in.close()
+    except Exception:
+        # don't leave the chunks written so far behind
+        chunks = get_db(proxy.db_alias)['%s.chunks' % proxy.collection_name]
+        chunks.delete_many({'files_id': grid_in._id})
+        raise
+    proxy.grid_id = grid_in._id
+    proxy.gridout = None
+    proxy._mark_as_changed()
+    return grid_in.length
+
+
+def _overrides_put(proxy):
+    put = six.get_unbound_function(type(proxy).put)
+    return put is not six.get_unbound_function(GridFSProxy.put)
+
+
+def _put(proxy, upload, chunk_size, **kwargs):
+    """
+    Writes ``upload`` with the ``put`` method of ``proxy``, which refuses
+    to write if the proxy already has a file.
+    """
+    if chunk_size is not None:
+        kwargs['chunk_size'] = chunk_size
+    grid_id = proxy.grid_id
+    proxy.grid_id = None
+    try:
+        proxy.put(upload, **kwargs)
+    except Exception:
+        proxy.grid_id = grid_id
+        raise
+    proxy.gridout = None
+
+
+def _adopt_file(proxy, upload, field, files, filename=None):
+    """
+    Makes the file ``GridFSUploadHandler`` wrote for ``upload`` the file
+    of ``proxy``, giving it its final name.
+    """
+    grid_id = upload.grid_id
+    extra = {}
+    if deduplicates(field):
+        duplicate = _find_duplicate(files, upload.sha256, upload.size,
+                                    grid_id)
+        if duplicate is not None:
+            # the content is already stored, drop the uploaded copy
+            GridFS(files.database, field.collection_name).delete(grid_id)
+            grid_id = duplicate
+        else:
+            extra = {'sha256': upload.sha256, 'refcount': 1}
+
+    if grid_id == upload.grid_id:
+        strategy = get_filename_strategy(field)
+        for attempt in range(MAX_ATTEMPTS):
+            if filename is None or attempt:
+                filename = strategy.get_filename(upload.name, upload, files)
+            extra['filename'] = filename
+            try:
+                files.update_one({'_id': grid_id},
+                                 {'$set': extra, '$unset': {'pending': ''}})
+            except DuplicateKeyError:
+                if attempt + 1 == MAX_ATTEMPTS:
+                    raise
+            else:
+                break
+
+    proxy.grid_id = grid_id
+    proxy.gridout = None
+    proxy._mark_as_changed()
+    return proxy
+
+
+def put_file(proxy, upload, field, filename=None):
+    """
+    Writes ``upload`` to the GridFS of ``proxy`` under the name the
+    filename strategy of ``field`` chooses. ``field`` is the mongoengine
+    ``FileField``, for list and map fields the one they contain.
+
+    Files ``GridFSUploadHandler`` already wrote to the same GridFS are
+    used as they are. Other files of the upload handler are copied, and
+    so are its files for proxies that override ``put``, which write the
+    upload with it. The copied file is deleted.
+
+    ``filename`` is used instead of asking the strategy unless it turns
+    out to be taken.
+    """
+    db = get_db(field.db_alias)
+    files = db['%s.files' % field.collection_name]
+    if getattr(settings, 'MONGODBFORMS_GRIDFS_UNIQUE_FILENAMES', False):
+        _ensure_index(files, 'filename', unique=True)
+    own_put = _overrides_put(proxy)
+    handled = isinstance(upload, GridFSUploadedFile)
+    if handled and not own_put and \
+            upload.db_alias == field.db_alias and \
+            upload.collection_name == field.collection_name:
+        return _adopt_file(proxy, upload, field, files, filename)
+    digest = None
+    extra = {}
+    if deduplicates(field) and not own_put:
+        digest = hashlib.sha256()
+        extra = {'refcount': 1}
+    strategy = get_filename_strategy(field)
+    chunk_size = get_chunk_size(field)
+    content_type = getattr(upload, 'content_type', None)
+
+    for attempt in range(MAX_ATTEMPTS):
+        if filename is None or attempt:
+            upload.seek(0)
+            filename = strategy.get_filename(upload.name, upload, files)
+        upload.seek(0)
+        if digest is not None:
+            digest = hashlib.sha256()
+        try:
+            if own_put:
+                _put(proxy, upload, chunk_size, content_type=content_type,
+                     filename=filename)
+            else:
+                length = _stream_file(proxy, upload, chunk_size, digest,
+                                      content_type=content_type,
+                                      filename=filename, **extra)
+        except (DuplicateKeyError, FileExists):
+            # GridIn reports duplicate keys as FileExists
+            if attempt + 1 == MAX_ATTEMPTS:
+                raise
+        else:
+            break
+
+    if digest is not None:
+        _deduplicate(proxy, files, field, digest.hexdigest(), length)
+    if handled:
+        # the file was copied, the one the upload handler wrote is unused
+        GridFS(get_db(upload.db_alias),
+               upload.collection_name).delete(upload.grid_id)
+    return proxy
+
+
+def choose_filenames(field, uploads):
+    """
+    Returns the filenames the uploads in ``uploads`` are stored under when
+    they are written to ``field`` at the same time.
+    """
+    files = get_db(field.db_alias)['%s.files' % field.collection_name]
+    return get_filename_strategy(field).get_filenames(
+        [(upload.name, upload) for upload in uploads], files)
+
+
+def delete_file(proxy):
+    """
+    Deletes the file of ``proxy``. A deduplicated file that is still used
+    by other proxies only loses one reference.
+    """
+    files = get_db(proxy.db_alias)['%s.files' % proxy.collection_name]
+    doc = files.find_one_and_update(
+        {'_id': proxy.grid_id, 'refcount': {'$gt': 1}},
+        {'$inc': {'refcount': -1}}, projection={'_id': True})
+    if doc is None:
+        proxy.delete()
+    else:
+        proxy.grid_id = None
+        proxy.gridout = None
+        proxy._mark_as_changed()
+
+
+def delete_files(db_alias, collection_name, grid_ids):
+    """
+    Deletes the files with ``grid_ids`` from a GridFS with a few batched
+    queries. Deduplicated files lose one reference for every time their id
+    is given and are only deleted if none is left.
+    """
+    db = get_db(db_alias)
+    files = db['%s.files' % collection_name]
+    chunks = db['%s.chunks' % collection_name]
+    by_count = {}
+    for grid_id, count in Counter(grid_ids).items():
+        by_count.setdefault(count, []).append(grid_id)
+    for count, ids in by_count.items():
+        files.delete_many({'_id': {'$in': ids}, '$or': [
+            {'refcount': {'$exists': False}},
+            {'refcount': {'$lte': count}},
+        ]})
+        kept = set(doc['_id'] for doc in
+                   files.find({'_id': {'$in': ids}}, {'_id': True}))
+        deleted = [grid_id for grid_id in ids if grid_id not in kept]
+        if deleted:
+            chunks.delete_many({'files_id': {'$in': deleted}})
+        if kept:
+            files.update_many({'_id': {'$in': list(kept)}},
+                              {'$inc': {'refcount': -count}})
+
+
+class DeletionQueue(object):
+    """
+    Collects the ids of files that should be deleted later, grouped by
+    the GridFS they are stored in.
+    """
+
+    def __init__(self):
+        self._grid_ids = OrderedDict()
+
+    def add(self, db_alias, collection_name, grid_id):
+        self._grid_ids.setdefault((db_alias, collection_name),
+                                  []).append(grid_id)
+
+    def extend(self, other):
+        for key, grid_ids in other._grid_ids.items():
+            self._grid_ids.setdefault(key, []).extend(grid_ids)
+
+    def clear(self):
+        self._grid_ids.clear()
+
+    def flush(self):
+        """Deletes all queued files and empties the queue."""
+        grid_ids, self._grid_ids = self._grid_ids, OrderedDict()
+        for (db_alias, collection_name), ids in grid_ids.items():
+            delete_files(db_alias, collection_name, ids)
+
+    def __len__(self):
+        return sum(len(ids) for ids in self._grid_ids.values())
+
+
+def _detach_files(document, queue):
+    """
+    Adds the files of the file fields of ``document`` to ``queue`` and
+    clears their proxies, so ``Document.delete`` leaves them alone.
+    Returns the ``(proxy, grid id)`` pairs to undo it with.
+    """
+    detached = []
+    for name, field in document._fields.items():
+        if not isinstance(field, FileField):
+            continue
+        proxy = getattr(document, name)
+        # these proxies are not deduplicated and may delete more in delete()
+        if not proxy.grid_id or _overrides_put(proxy):
+            continue
+        queue.add(proxy.db_alias, proxy.collection_name, proxy.grid_id)
+        detached.append((proxy, proxy.grid_id))
+        proxy.grid_id = None
+    return detached
+
+
+def delete_document(document):
+    """
+    Deletes ``document`` like ``Document.delete``, but the files of its
+    file fields are deleted with ``delete_files`` once the document is
+    gone, so deduplicated files other documents use are kept.
+    """
+    queue = DeletionQueue()
+    detached = _detach_files(document, queue)
+    try:
+        document.delete()
+    except Exception:
+        for proxy, grid_id in detached:
+            proxy.grid_id = grid_id
+        raise
+    queue.flush()
+
+
+def delete_documents(document_class, documents):
+    """
+    Deletes ``documents``, instances of ``document_class``, with one query
+    that follows the delete rules of ``document_class``, and then their
+    files like ``delete_document``. If anything receives the delete
+    signals of ``document_class`` the documents are deleted one by one,
+    as mongoengine needs to send the signals for each of them.
+    """
+    if signals.signals_available and (
+            signals.pre_delete.has_receivers_for(document_class) or
+            signals.post_delete.has_receivers_for(document_class)):
+        for document in documents:
+            delete_document(document)
+        return
+    queue = DeletionQueue()
+    detached = []
+    proxies = []
+    for document in documents:
+        detached.extend(_detach_files(document, queue))
+        proxies.extend(getattr(document, name)
+                       for name, field in document._fields.items()
+                       if isinstance(field, FileField))
+    try:
+        document_class.objects(pk__in=[d.pk for d in documents]).delete()
+    except Exception:
+        for proxy, grid_id in detached:
+            proxy.grid_id = grid_id
+        raise
+    queue.flush()
+    # the files Document.delete would have deleted itself
+    for proxy in proxies:
+        if proxy.grid_id:
+            proxy.delete()
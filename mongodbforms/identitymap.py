@@ -0,0 +1,97 @@
+"""
+An identity map for the documents referenced by a form or formset.
+
+Every document loaded by pk while a form or formset is processed is kept, so
+the same author or category showing up in several fields or rows is only
+fetched once.
+"""
+try:
+    from django.utils.encoding import force_text as force_unicode
+except ImportError:
+    from django.utils.encoding import force_unicode
+
+
+def is_unfiltered(queryset):
+    """
+    Returns True if ``queryset`` contains all documents of its collection.
+    Documents from the identity map may only be used for those, everything
+    else has to ask the database whether the document is in the queryset.
+    """
+    return (queryset._query_obj.empty and
+            not getattr(queryset, '_none', False) and
+            not getattr(queryset, '_where_clause', None) and
+            not queryset._skip and queryset._limit is None)
+
+
+class IdentityMap(object):
+    """
+    Maps ``(collection name, pk)`` to the loaded document. Lookups count
+    hits and misses.
+    """
+
+    def __init__(self):
+        self._documents = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, document, pk):
+        return (document._get_collection_name(), force_unicode(pk))
+
+    def add(self, obj):
+        """Adds a document. Anything without a pk is ignored."""
+        if not hasattr(obj, '_get_collection_name') or obj.pk is None:
+            return
+        self._documents[self._key(obj, obj.pk)] = obj
+
+    def add_many(self, objs):
+        for obj in objs:
+            self.add(obj)
+
+    def get(self, document, pk):
+        """
+        Returns the document of class ``document`` with the given pk or
+        None if it wasn't loaded yet.
+        """
+        obj = self._documents.get(self._key(document, pk))
+        # documents that share a collection also share the map
+        if obj is not None and isinstance(obj, document):
+            self.hits += 1
+            return obj
+        self.misses += 1
+        return None
+
+    def get_many(self, document, pks):
+        """
+        Returns a dict of the loaded documents keyed by their pk as text
+        and a list of the pks that still need to be loaded.
+        """
+        found = {}
+        missing = []
+        for pk in pks:
+            obj = self.get(document, pk)
+            if obj is None:
+                missing.append(pk)
+            else:
+                found[force_unicode(pk)] = obj
+        return found, missing
+
+    def update(self, other):
+        self._documents.update(other._documents)
+
+    def clear(self):
+        self._documents.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._documents),
+        }
+
+    def __len__(self):
+        return len(self._documents)
+
+    def __contains__(self, obj):
+        return self._key(obj, obj.pk) in self._documents
@@ -0,0 +1,274 @@
+"""
+Deletes GridFS files that no document references anymore.
+
+Every registered mongoengine document with a ``FileField`` somewhere in
+its fields, including inside list, map and embedded document fields, is
+read with a projection on the fields that can hold files. Generic embedded
+document fields are followed into the documents in their ``choices``.
+Without ``choices`` they may hold files of any GridFS and are always
+read, but GridFS collections only they use can't be found and are not
+cleaned. Every ObjectId
+found in them counts as a live file, which errs on the side of keeping
+files. All other files of the GridFS collections those fields use, and
+chunks without a files document, are orphans.
+"""
+import time
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import six
+
+from mongoengine import Document, DynamicDocument
+from mongoengine.base.common import _document_registry
+from mongoengine.connection import get_db, DEFAULT_CONNECTION_NAME
+from mongoengine.fields import (FileField, ComplexBaseField,
+                                EmbeddedDocumentField,
+                                GenericEmbeddedDocumentField)
+from mongoengine.base import get_document
+from bson.objectid import ObjectId
+
+
+# stands for GridFS collections that can't be known
+UNKNOWN = None
+
+
+def _embedded_collections(document, seen):
+    if document in seen:
+        return set()
+    seen.add(document)
+    collections = set()
+    for f in document._fields.values():
+        collections |= _file_collections(f, seen)
+    return collections
+
+
+def _file_collections(field, seen):
+    """
+    Returns the ``(db alias, collection name)`` pairs of the GridFS
+    collections the files in ``field`` are stored in. ``UNKNOWN`` is
+    among them if the field can hold files of any GridFS.
+    """
+    if isinstance(field, FileField):
+        return set([(field.db_alias, field.collection_name)])
+    if isinstance(field, ComplexBaseField) and field.field is not None:
+        return _file_collections(field.field, seen)
+    if isinstance(field, EmbeddedDocumentField):
+        return _embedded_collections(field.document_type, seen)
+    if isinstance(field, GenericEmbeddedDocumentField):
+        if not field.choices:
+            return set([UNKNOWN])
+        collections = set()
+        for document in field.choices:
+            if isinstance(document, six.string_types):
+                document = get_document(document)
+            collections |= _embedded_collections(document, seen)
+        return collections
+    return set()
+
+
+def _collect_ids(value, ids):
+    if isinstance(value, ObjectId):
+        ids.add(value)
+    elif isinstance(value, dict):
+        for v in value.values():
+            _collect_ids(v, ids)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            _collect_ids(v, ids)
+
+
+def _file_documents():
+    """
+    Returns a dict mapping the collections of the registered documents
+    to the fields that can hold files, or None if the whole document has
+    to be read, the set of GridFS collections used and the names of the
+    fields that can hold files of unknown GridFS collections.
+    """
+    roots = {}
+    gridfs = set()
+    unknown = []
+    for document in set(_document_registry.values()):
+        if not issubclass(document, Document) or \
+                document._meta.get('abstract'):
+            continue
+        fields = set()
+        for f in document._fields.values():
+            collections = _file_collections(f, set())
+            if UNKNOWN in collections:
+                collections.discard(UNKNOWN)
+                unknown.append('%s.%s' % (document.__name__, f.name))
+                fields.add(f.db_field)
+            if collections:
+                gridfs |= collections
+                fields.add(f.db_field)
+        dynamic = issubclass(document, DynamicDocument)
+        if not fields and not dynamic:
+            continue
+        key = (document._meta.get('db_alias', DEFAULT_CONNECTION_NAME),
+               document._get_collection_name())
+        if dynamic:
+            # any key of a dynamic document can hold a file
+            roots[key] = None
+        elif key not in roots or roots[key] is not None:
+            roots[key] = roots.get(key, set()) | fields
+    return roots, gridfs, unknown
+
+
+class Command(BaseCommand):
+    help = ("Deletes GridFS files that are not referenced by any document. "
+            "Only files older than --older-than hours are considered.")
+
+    if not hasattr(BaseCommand, 'add_arguments'):
+        # Django < 1.8 parses options with optparse
+        option_list = BaseCommand.option_list + (
+            make_option('--dry-run', action='store_true', dest='dry_run',
+                        default=False,
+                        help='Only report the orphaned files.'),
+            make_option('--batch-size', type='int', dest='batch_size',
+                        default=1000,
+                        help='Number of files deleted per query.'),
+            make_option('--sleep', type='float', dest='sleep', default=0,
+                        help='Seconds to wait between two batches.'),
+            make_option('--older-than', type='float', dest='older_than',
+                        default=24,
+                        help='Minimum age in hours of deleted files.'),
+        )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            dest='dry_run', default=False,
+                            help='Only report the orphaned files.')
+        parser.add_argument('--batch-size', type=int, dest='batch_size',
+                            default=1000,
+                            help='Number of files deleted per query.')
+        parser.add_argument('--sleep', type=float, dest='sleep', default=0,
+                            help='Seconds to wait between two batches.')
+        parser.add_argument('--older-than', type=float, dest='older_than',
+                            default=24,
+                            help='Minimum age in hours of deleted files.')
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.batch_size = options['batch_size']
+        self.sleep = options['sleep']
+        cutoff = datetime.utcnow() - timedelta(hours=options['older_than'])
+        verbosity = int(options.get('verbosity', 1))
+
+        roots, gridfs, unknown = _file_documents()
+        for name in sorted(unknown):
+            self.stderr.write('%s is a generic embedded document field '
+                              'without choices. Its files are kept, but '
+                              'GridFS collections only it uses are not '
+                              'cleaned.\n' % name)
+        # files uploaded by GridFSUploadHandler but never saved
+        gridfs.add((getattr(settings, 'MONGODBFORMS_UPLOAD_DB_ALIAS',
+                            DEFAULT_CONNECTION_NAME),
+                    getattr(settings, 'MONGODBFORMS_UPLOAD_COLLECTION',
+                            'fs')))
+
+        live = set()
+        for (db_alias, collection_name), fields in roots.items():
+            collection = get_db(db_alias)[collection_name]
+            if fields is None:
+                cursor = collection.find({})
+            else:
+                cursor = collection.find({}, dict((f, True) for f in fields))
+            for doc in cursor.batch_size(self.batch_size):
+                doc.pop('_id', None)
+                _collect_ids(doc, live)
+        if verbosity > 1:
+            self.stdout.write('%d referenced files\n' % len(live))
+
+        for db_alias, collection_name in sorted(gridfs):
+            files, chunks = self.clean_gridfs(db_alias, collection_name,
+                                              live, cutoff)
+            verb = 'Found' if self.dry_run else 'Deleted'
+            self.stdout.write('%s %d orphaned files and the chunks of %d '
+                              'missing files in %s.%s\n' %
+                              (verb, files, chunks, db_alias,
+                               collection_name))
+
+    def clean_gridfs(self, db_alias, collection_name, live, cutoff):
+        db = get_db(db_alias)
+        files = db['%s.files' % collection_name]
+        chunks = db['%s.chunks' % collection_name]
+
+        # thumbnails of ImageFields are only referenced by their image
+        cursor = files.find({'thumbnail_id': {'$exists': True}},
+                            {'thumbnail_id': True})
+        for doc in cursor.batch_size(self.batch_size):
+            if doc['_id'] in live:
+                live.add(doc['thumbnail_id'])
+
+        orphans = 0
+        batch = []
+        cursor = files.find({'uploadDate': {'$lt': cutoff}},
+                            {'refcount': True})
+        for doc in cursor.batch_size(self.batch_size):
+            if doc['_id'] in live:
+                continue
+            batch.append((doc['_id'], doc.get('refcount')))
+            if len(batch) >= self.batch_size:
+                orphans += self.delete_files(files, chunks, batch)
+                batch = []
+        if batch:
+            orphans += self.delete_files(files, chunks, batch)
+
+        # chunks whose files document is gone. Uploads in progress write
+        # their chunks first, so only chunks of old files are deleted.
+        missing = 0
+        batch = []
+        groups = chunks.aggregate([
+            {'$match': {'files_id': {'$lt': ObjectId.from_datetime(cutoff)}}},
+            {'$group': {'_id': '$files_id'}},
+        ], allowDiskUse=True, batchSize=self.batch_size)
+        for group in groups:
+            if group['_id'] in live:
+                continue
+            batch.append(group['_id'])
+            if len(batch) >= self.batch_size:
+                missing += self.delete_chunks(files, chunks, batch)
+                batch = []
+        if batch:
+            missing += self.delete_chunks(files, chunks, batch)
+        return orphans, missing
+
+    def delete_chunks(self, files, chunks, files_ids):
+        """Deletes the chunks of those ``files_ids`` that have no file."""
+        existing = set(doc['_id'] for doc in
+                       files.find({'_id': {'$in': files_ids}}, {'_id': True}))
+        missing = [files_id for files_id in files_ids
+                   if files_id not in existing]
+        if missing and not self.dry_run:
+            chunks.delete_many({'files_id': {'$in': missing}})
+            self.pause()
+        return len(missing)
+
+    def delete_files(self, files, chunks, batch):
+        """
+        Deletes a batch of ``(grid id, refcount)`` pairs. Files whose
+        refcount changed since they were read were reused and are kept.
+        """
+        if self.dry_run:
+            return len(batch)
+        ids = [grid_id for grid_id, refcount in batch]
+        plain = [grid_id for grid_id, refcount in batch if refcount is None]
+        conditions = [{'_id': grid_id, 'refcount': refcount}
+                      for grid_id, refcount in batch if refcount is not None]
+        if plain:
+            conditions.append({'_id': {'$in': plain},
+                               'refcount': {'$exists': False}})
+        files.delete_many({'$or': conditions})
+        kept = set(doc['_id'] for doc in
+                   files.find({'_id': {'$in': ids}}, {'_id': True}))
+        deleted = [grid_id for grid_id in ids if grid_id not in kept]
+        if deleted:
+            chunks.delete_many({'files_id': {'$in': deleted}})
+        self.pause()
+        return len(deleted)
+
+    def pause(self):
+        if self.sleep:
+            time.sleep(self.sleep)
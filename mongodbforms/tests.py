@@ -19,9 +19,100 @@ settings.configure(
 )
 
 
+import gc
+import hashlib
+import io
+import json
+import unittest
+import weakref
+
 import mongoengine
-from django.test import SimpleTestCase
-from mongodbforms.documentoptions import LazyDocumentMetaWrapper
+from bson.objectid import ObjectId
+from django import forms
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import StopFutureHandlers
+from django.core.management import call_command
+from django.utils import six
+from django.utils.six import StringIO
+from django.test import SimpleTestCase, RequestFactory
+try:
+    import mongomock
+    import mongomock.gridfs
+except ImportError:
+    mongomock = None
+from mongodbforms.documentoptions import (LazyDocumentMetaWrapper,
+                                          DocumentMetaWrapper, PkWrapper,
+                                          get_meta_wrapper)
+from mongodbforms.identitymap import IdentityMap
+from mongodbforms.util import LRUCache
+from mongodbforms import choicecache
+from mongodbforms.fields import MongoCharField, ReferenceField
+from mongodbforms.fieldgenerator import MongoFormFieldGenerator
+from mongodbforms.uploadhandler import GridFSUploadHandler
+from mongodbforms.views import reference_search_view
+from mongodbforms.widgets import (ReferenceSearchWidget,
+                                  ReferenceSearchMultipleWidget)
+from mongodbforms.documents import (LazyInitial, ConstructPlan,
+                                    _get_field_plan, _map_uploads,
+                                    _save_list_files,
+                                    _save_iterator_file, fields_for_document,
+                                    DocumentForm, documentform_factory,
+                                    documentformset_factory,
+                                    inlineformset_factory,
+                                    BaseDocumentFormSet,
+                                    form_class_cache_stats,
+                                    clear_form_class_cache)
+from mongodbforms.filestorage import (SuffixFilenameStrategy,
+                                      UUIDFilenameStrategy,
+                                      get_filename_strategy, deduplicates,
+                                      _hash_upload, _iter_chunks,
+                                      DeletionQueue, put_file, delete_file,
+                                      delete_document)
+
+
+@unittest.skipIf(mongomock is None, 'mongomock is not installed')
+class MongoTestCase(SimpleTestCase):
+    """Runs against an in-memory mongomock database."""
+    documents = ()
+
+    @classmethod
+    def setUpClass(cls):
+        super(MongoTestCase, cls).setUpClass()
+        mongoengine.connect('mongodbforms_tests', host='mongomock://localhost')
+
+    def setUp(self):
+        for document in self.documents:
+            document.drop_collection()
+
+
+class GridFSTestCase(MongoTestCase):
+    """Runs against mongomock with GridFS support."""
+
+    @classmethod
+    def setUpClass(cls):
+        super(GridFSTestCase, cls).setUpClass()
+        mongomock.gridfs.enable_gridfs_integration()
+
+    def setUp(self):
+        super(GridFSTestCase, self).setUp()
+        self.db = mongoengine.connection.get_db()
+        self.db['fs.files'].drop()
+        self.db['fs.chunks'].drop()
+
+    def filenames(self):
+        return sorted(doc['filename'] for doc in self.db['fs.files'].find())
+
+
+def formset_data(rows, initial=0, prefix='form'):
+    data = {
+        '%s-TOTAL_FORMS' % prefix: str(len(rows)),
+        '%s-INITIAL_FORMS' % prefix: str(initial),
+        '%s-MAX_NUM_FORMS' % prefix: '1000',
+    }
+    for i, row in enumerate(rows):
+        for name, value in row.items():
+            data['%s-%d-%s' % (prefix, i, name)] = value
+    return data
 
 
 class TestDocument(mongoengine.Document):
@@ -48,3 +139,1127 @@ class LazyWrapperTest(SimpleTestCase):
         meta = LazyDocumentMetaWrapper(TestDocument)
         meta.custom = 'yes'
         self.assertEqual(meta.custom, 'yes')
+
+
+class DocumentMetaWrapperTest(SimpleTestCase):
+
+    def test_attributes(self):
+        meta = DocumentMetaWrapper(TestDocument, {'abstract': True})
+        meta.custom = 'yes'
+        self.assertEqual(meta['custom'], 'yes')
+        self.assertTrue(meta.abstract)
+        self.assertEqual(meta.model_name, 'testdocument')
+        self.assertEqual(meta.module_name, 'testdocument')
+        self.assertRaises(AttributeError, getattr, meta, 'missing')
+
+    @unittest.skipIf(six.PY2, "Python 2's MutableMapping has no __slots__")
+    def test_no_instance_dict(self):
+        meta = DocumentMetaWrapper(TestDocument, {'abstract': True})
+        self.assertFalse(hasattr(meta, '__dict__'))
+        meta.custom = 'yes'
+        self.assertFalse(hasattr(meta, '__dict__'))
+
+    def test_wrapper_does_not_keep_document(self):
+        # mongoengine keeps its document classes alive itself
+        class Temporary(object):
+            _meta = {}
+        wrapper = get_meta_wrapper(Temporary)
+        self.assertTrue(Temporary._meta is wrapper)
+        self.assertTrue(get_meta_wrapper(Temporary) is wrapper)
+        ref = weakref.ref(Temporary)
+        del Temporary, wrapper
+        gc.collect()
+        self.assertEqual(ref(), None)
+
+    def test_glues_selected_fields(self):
+        class Glued(mongoengine.Document):
+            meta = {'abstract': True}
+            title = mongoengine.StringField()
+            body = mongoengine.StringField()
+        formfields = fields_for_document(Glued, fields=['title'])
+        self.assertEqual(list(formfields), ['title'])
+        self.assertTrue(getattr(Glued._fields['title'], '_django_glue',
+                                False))
+        self.assertFalse(getattr(Glued._fields['body'], '_django_glue',
+                                 False))
+
+
+class Author(mongoengine.Document):
+    name = mongoengine.StringField(primary_key=True)
+
+
+class PkWrapperTest(SimpleTestCase):
+
+    def test_proxy(self):
+        field = mongoengine.StringField(max_length=5)
+        pk = PkWrapper(field)
+        self.assertFalse(pk.editable)
+        self.assertFalse(pk.fake)
+        self.assertEqual(pk.max_length, 5)
+        pk.name = 'slug'
+        self.assertEqual(pk.name, 'slug')
+        self.assertEqual(field.name, 'slug')
+        pk.attname = 'slug'
+        self.assertEqual(pk.attname, 'slug')
+        self.assertRaises(AttributeError, getattr, pk, 'missing')
+        self.assertIn('max_length', dir(pk))
+
+    def test_without_field(self):
+        pk = PkWrapper(None)
+        pk.fake = True
+        self.assertTrue(pk.fake)
+        self.assertRaises(AttributeError, getattr, pk, 'name')
+
+
+class IdentityMapTest(SimpleTestCase):
+
+    def test_get_counts_hits_and_misses(self):
+        imap = IdentityMap()
+        author = Author(name='jan')
+        imap.add(author)
+
+        self.assertTrue(imap.get(Author, 'jan') is author)
+        self.assertEqual(imap.get(Author, 'someone'), None)
+        self.assertEqual(imap.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_get_many(self):
+        imap = IdentityMap()
+        imap.add(Author(name='jan'))
+
+        found, missing = imap.get_many(Author, ['jan', 'someone'])
+        self.assertEqual(list(found.keys()), ['jan'])
+        self.assertEqual(missing, ['someone'])
+
+
+class LRUCacheTest(SimpleTestCase):
+
+    def test_drops_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(),
+                         {'hits': 3, 'misses': 1, 'size': 2, 'maxsize': 2})
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+
+class FactoryCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        clear_form_class_cache()
+
+    def test_same_arguments(self):
+        form = documentform_factory(Person, fields=['name', 'age'])
+        self.assertTrue(
+            documentform_factory(Person, fields=['name', 'age']) is form)
+        formset = documentformset_factory(Person, exclude=['code'])
+        self.assertTrue(
+            documentformset_factory(Person, exclude=['code']) is formset)
+        self.assertEqual(form_class_cache_stats()['hits'], 2)
+
+    def test_different_arguments(self):
+        form = documentform_factory(Person, fields=['name', 'age'])
+        self.assertFalse(
+            documentform_factory(Person, fields=['name']) is form)
+        self.assertFalse(
+            documentform_factory(Person, exclude=['code']) is form)
+        self.assertFalse(
+            documentform_factory(Person, exclude=['age']) is
+            documentform_factory(Person, exclude=['code']))
+
+        class HiddenNameForm(DocumentForm):
+            class Meta:
+                widgets = {'name': forms.HiddenInput}
+        hidden_form = documentform_factory(Person, form=HiddenNameForm,
+                                           fields=['name', 'age'])
+        self.assertFalse(hidden_form is form)
+        self.assertTrue(isinstance(hidden_form.base_fields['name'].widget,
+                                   forms.HiddenInput))
+        self.assertFalse(isinstance(form.base_fields['name'].widget,
+                                    forms.HiddenInput))
+
+    def test_unhashable_arguments(self):
+        fields = set(['name', 'age'])
+        form = documentform_factory(Person, fields=fields)
+        self.assertFalse(documentform_factory(Person, fields=fields) is form)
+        self.assertEqual(sorted(form.base_fields), ['age', 'name'])
+        self.assertEqual(form_class_cache_stats()['size'], 0)
+
+
+class NameField(mongoengine.StringField):
+    pass
+
+
+class ShortNameField(NameField):
+    pass
+
+
+class ColorField(mongoengine.fields.BaseField):
+    pass
+
+
+def document_field(field):
+    """Returns ``field`` set up as it is when generated for a document."""
+    document = type('FieldDocument', (mongoengine.Document,), {
+        'meta': {'abstract': True},
+        'name': field,
+    })
+    return DocumentMetaWrapper(document).get_field('name')
+
+
+class FieldGeneratorTest(SimpleTestCase):
+
+    def test_generate_follows_mro(self):
+        field = document_field(ShortNameField(max_length=10))
+        formfield = MongoFormFieldGenerator().generate(field)
+        self.assertTrue(isinstance(formfield, MongoCharField))
+
+    def test_register_generator(self):
+        class ColorGenerator(MongoFormFieldGenerator):
+            def generate_color(self, field, **kwargs):
+                return forms.CharField(max_length=7, **kwargs)
+        ColorGenerator.register_generator(ColorField, 'generate_color')
+
+        formfield = ColorGenerator().generate(ColorField())
+        self.assertEqual(formfield.max_length, 7)
+        self.assertRaises(NotImplementedError,
+                          MongoFormFieldGenerator().generate, ColorField())
+
+    def test_overrides_are_per_instance(self):
+        MongoFormFieldGenerator(field_overrides={
+            'stringfield': forms.CharField,
+        })
+        self.assertTrue(
+            MongoFormFieldGenerator.form_field_map['stringfield'] is
+            MongoCharField
+        )
+
+    def test_callable_default_is_not_called(self):
+        calls = []
+
+        def default():
+            calls.append(1)
+            return 'default'
+        field = document_field(mongoengine.StringField(default=default))
+        formfield = MongoFormFieldGenerator().generate(field)
+        self.assertTrue(formfield.initial is default)
+        self.assertEqual(calls, [])
+
+
+class FieldPlanTest(SimpleTestCase):
+
+    def test_plan_is_reused(self):
+        first = fields_for_document(Attachment, fields=['title'])
+        plan = _get_field_plan(Attachment, MongoFormFieldGenerator)
+        second = fields_for_document(Attachment, fields=['title'])
+        self.assertTrue(_get_field_plan(Attachment,
+                                        MongoFormFieldGenerator) is plan)
+        self.assertFalse(first['title'] is second['title'])
+
+    def test_redefined_document(self):
+        class Redefined(mongoengine.Document):
+            meta = {'abstract': True}
+            title = mongoengine.StringField(max_length=10)
+        old = Redefined
+        self.assertEqual(
+            fields_for_document(old)['title'].max_length, 10)
+
+        class Redefined(mongoengine.Document):
+            meta = {'abstract': True}
+            title = mongoengine.StringField(max_length=20)
+            body = mongoengine.StringField()
+        formfields = fields_for_document(Redefined)
+        self.assertEqual(list(formfields), ['title', 'body'])
+        self.assertEqual(formfields['title'].max_length, 20)
+        self.assertFalse(
+            _get_field_plan(Redefined, MongoFormFieldGenerator).document
+            is old)
+
+    def test_added_field(self):
+        class Growing(mongoengine.Document):
+            meta = {'abstract': True}
+            title = mongoengine.StringField(max_length=10)
+        self.assertEqual(list(fields_for_document(Growing)), ['title'])
+
+        body = mongoengine.StringField(max_length=30)
+        body.name = body.db_field = 'body'
+        Growing._fields['body'] = body
+        Growing._fields_ordered += ('body',)
+        formfields = fields_for_document(Growing)
+        self.assertEqual(list(formfields), ['title', 'body'])
+        self.assertEqual(formfields['body'].max_length, 30)
+
+
+class LazyInitialTest(SimpleTestCase):
+
+    def test_called_once(self):
+        calls = []
+
+        def default():
+            calls.append(1)
+            return len(calls)
+        initial = LazyInitial(default)
+        self.assertEqual(initial(), 1)
+        self.assertEqual(initial(), 1)
+        self.assertEqual(calls, [1])
+
+
+class Attachment(mongoengine.Document):
+    meta = {'abstract': True}
+
+    title = mongoengine.StringField()
+    notes = mongoengine.StringField()
+    other = mongoengine.ObjectIdField()
+    file = mongoengine.FileField()
+    gallery = mongoengine.ListField(mongoengine.FileField())
+    files = mongoengine.MapField(mongoengine.FileField())
+
+
+class ConstructPlanTest(SimpleTestCase):
+
+    def test_plan(self):
+        plan = ConstructPlan(Attachment._fields, exclude=['notes'])
+        self.assertIn('title', plan.plain)
+        self.assertNotIn('notes', plan.plain)
+        self.assertIn('notes', plan.skipped)
+        self.assertIn('other', plan.skipped)
+        self.assertEqual(sorted(plan.files), [
+            ('file', 'file'), ('files', 'map'), ('gallery', 'list')])
+
+    def test_fields(self):
+        plan = ConstructPlan(Attachment._fields, fields=['title', 'file'])
+        self.assertEqual(plan.plain, ('title',))
+        self.assertEqual(plan.files, (('file', 'file'),))
+
+
+class FilesCollection(object):
+
+    def __init__(self, names):
+        self.names = names
+
+    def find(self, spec, projection):
+        name, pattern = spec['filename']['$in']
+        return [{'filename': n} for n in self.names
+                if n == name or pattern.match(n)]
+
+
+class FilenameStrategyTest(SimpleTestCase):
+
+    def test_suffix(self):
+        strategy = SuffixFilenameStrategy()
+        files = FilesCollection(['a.jpg', 'a_1.jpg', 'a_7.jpg', 'b_9.jpg'])
+        self.assertEqual(strategy.get_filename('a.jpg', None, files),
+                         'a_8.jpg')
+        self.assertEqual(strategy.get_filename('b.jpg', None, files),
+                         'b.jpg')
+        self.assertEqual(strategy.get_filename('a.png', None, files),
+                         'a.png')
+
+    def test_suffix_batch(self):
+        strategy = SuffixFilenameStrategy()
+        files = FilesCollection(['a.jpg', 'a_1.jpg'])
+        uploads = [(name, None) for name in
+                   ('a.jpg', 'b.jpg', 'a.jpg', 'b.jpg', 'b_1.jpg')]
+        self.assertEqual(strategy.get_filenames(uploads, files),
+                         ['a_2.jpg', 'b.jpg', 'a_3.jpg', 'b_1.jpg',
+                          'b_1_1.jpg'])
+
+    def test_uuid(self):
+        name = UUIDFilenameStrategy().get_filename('a.jpg', None, None)
+        self.assertTrue(name.endswith('.jpg'))
+        self.assertEqual(len(name), 36)
+
+    def test_field_strategy(self):
+        field = mongoengine.FileField()
+        self.assertIsInstance(get_filename_strategy(field),
+                              SuffixFilenameStrategy)
+        field.filename_strategy = UUIDFilenameStrategy
+        self.assertIsInstance(get_filename_strategy(field),
+                              UUIDFilenameStrategy)
+
+
+class DeduplicationTest(SimpleTestCase):
+
+    def test_hash_upload(self):
+        upload = io.BytesIO(b'content')
+        upload.read()
+        digest, length = _hash_upload(upload)
+        self.assertEqual(digest, hashlib.sha256(b'content').hexdigest())
+        self.assertEqual(length, 7)
+        self.assertEqual(upload.tell(), 0)
+
+    def test_deduplicates(self):
+        field = mongoengine.FileField()
+        self.assertFalse(deduplicates(field))
+        field.deduplicate = True
+        self.assertTrue(deduplicates(field))
+
+
+class StreamingTest(SimpleTestCase):
+
+    def test_iter_chunks(self):
+        upload = io.BytesIO(b'abcdefg')
+        self.assertEqual(list(_iter_chunks(upload, 3)),
+                         [b'abc', b'def', b'g'])
+
+
+class MapUploadsTest(SimpleTestCase):
+
+    def upload(self, item):
+        if item == 3:
+            raise IOError('failed')
+        return item * 2
+
+    def test_order(self):
+        for workers in (1, 4):
+            results = _map_uploads(self.upload, [5, 1, 4, 2], workers)
+            self.assertEqual(results, [(10, None), (2, None), (8, None),
+                                       (4, None)])
+
+    def test_errors(self):
+        results = _map_uploads(self.upload, [1, 3, 2], 4)
+        self.assertEqual(results[0], (2, None))
+        self.assertIsInstance(results[1][1], IOError)
+        self.assertEqual(results[2], (4, None))
+
+
+class DeletionQueueTest(SimpleTestCase):
+
+    def test_queue(self):
+        queue = DeletionQueue()
+        queue.add('default', 'fs', 1)
+        queue.add('default', 'images', 2)
+        other = DeletionQueue()
+        other.add('default', 'fs', 3)
+        queue.extend(other)
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(queue._grid_ids[('default', 'fs')], [1, 3])
+        queue.clear()
+        self.assertEqual(len(queue), 0)
+
+
+class Person(mongoengine.Document):
+    name = mongoengine.StringField(unique=True)
+    code = mongoengine.StringField(unique=True, sparse=True)
+    age = mongoengine.IntField()
+
+
+class Pet(mongoengine.Document):
+    name = mongoengine.StringField()
+    owner = mongoengine.ReferenceField(Person)
+
+
+class EditFormSet(BaseDocumentFormSet):
+    """Binds the initial forms to the documents of the queryset."""
+
+    def _construct_form(self, i, **kwargs):
+        if i < self.initial_form_count():
+            kwargs['instance'] = self.get_queryset()[i]
+        return super(EditFormSet, self)._construct_form(i, **kwargs)
+
+
+class FormSetUniqueTest(MongoTestCase):
+    documents = (Person,)
+
+    def get_formset(self, rows, queryset=None, initial=0):
+        formset_class = documentformset_factory(
+            Person, formset=EditFormSet, fields=['name', 'code', 'age'],
+            extra=0)
+        if queryset is None:
+            queryset = Person.objects.none()
+        return formset_class(formset_data(rows, initial), queryset=queryset)
+
+    def test_duplicate_rows(self):
+        formset = self.get_formset([{'name': 'a'}, {'name': 'a'}])
+        self.assertFalse(formset.is_valid())
+        self.assertEqual(formset.non_form_errors(),
+                         ['Please correct the duplicate data for name.'])
+        self.assertEqual(formset.errors[0], {})
+        self.assertIn('name', formset.errors[1])
+
+    def test_clean_without_super(self):
+        class CleanFormSet(EditFormSet):
+            def clean(self):
+                pass
+        Person(name='x').save()
+        formset_class = documentformset_factory(
+            Person, formset=CleanFormSet, fields=['name'], extra=0)
+        formset = formset_class(formset_data([{'name': 'x'}]),
+                                queryset=Person.objects.none())
+        self.assertFalse(formset.is_valid())
+        self.assertIn('name', formset.errors[0])
+
+    def test_inline_duplicate_rows(self):
+        formset_class = inlineformset_factory(Person, fields=['name'],
+                                              extra=0)
+        formset = formset_class(formset_data([{'name': 'a'}, {'name': 'a'}],
+                                             prefix='person'))
+        self.assertFalse(formset.is_valid())
+        self.assertEqual(formset.non_form_errors(),
+                         ['Please correct the duplicate data for name.'])
+
+    def test_existing_document(self):
+        Person(name='x').save()
+        formset = self.get_formset([{'name': 'y'}, {'name': 'x'}])
+        self.assertFalse(formset.is_valid())
+        self.assertEqual(formset.errors[0], {})
+        self.assertIn('name', formset.errors[1])
+
+    def test_edit_keeps_own_value(self):
+        Person(name='x', age=1).save()
+        formset = self.get_formset([{'name': 'x', 'age': '2'}],
+                                   queryset=Person.objects.all(), initial=1)
+        self.assertTrue(formset.is_valid(), formset.errors)
+
+    def test_swap_with_existing_value(self):
+        Person(name='x').save()
+        Person(name='y').save()
+        formset = self.get_formset([{'name': 'x'}, {'name': 'x'}],
+                                   queryset=Person.objects.order_by('name'),
+                                   initial=2)
+        self.assertFalse(formset.is_valid())
+        self.assertIn('name', formset.errors[1])
+
+    def test_empty_values_are_not_duplicates(self):
+        formset = self.get_formset([{'name': 'a'}, {'name': 'b'}])
+        self.assertTrue(formset.is_valid(), formset.errors)
+
+
+class BulkFormSet(EditFormSet):
+    bulk_save = True
+
+
+class Keeper(mongoengine.Document):
+    name = mongoengine.StringField()
+
+
+class Animal(mongoengine.Document):
+    keeper = mongoengine.ReferenceField(
+        Keeper, reverse_delete_rule=mongoengine.CASCADE)
+
+
+class Guard(mongoengine.Document):
+    keeper = mongoengine.ReferenceField(
+        Keeper, reverse_delete_rule=mongoengine.DENY)
+
+
+class BulkSaveTest(MongoTestCase):
+    documents = (Person, Keeper, Animal, Guard)
+
+    def get_formset(self, rows, initial=0, document=Person,
+                    fields=('name', 'age')):
+        formset_class = documentformset_factory(
+            document, formset=BulkFormSet, fields=list(fields), extra=0,
+            can_delete=True)
+        return formset_class(formset_data(rows, initial),
+                             queryset=document.objects.order_by('name'))
+
+    def delete_keeper(self):
+        formset = self.get_formset([{'name': 'a', 'DELETE': 'on'}],
+                                   initial=1, document=Keeper,
+                                   fields=['name'])
+        self.assertTrue(formset.is_valid(), formset.errors)
+        formset.save()
+        return formset
+
+    def test_delete_cascades(self):
+        Animal(keeper=Keeper(name='a').save()).save()
+        self.delete_keeper()
+        self.assertEqual(Keeper.objects.count(), 0)
+        self.assertEqual(Animal.objects.count(), 0)
+
+    def test_delete_denied(self):
+        Guard(keeper=Keeper(name='a').save()).save()
+        formset = self.delete_keeper()
+        self.assertEqual(Keeper.objects.count(), 1)
+        self.assertTrue(formset.forms[0].errors)
+
+    def test_invalidates_choice_cache(self):
+        field = ReferenceField(Person.objects, empty_label=None,
+                               choice_cache_timeout=60)
+        field.label_from_instance = lambda obj: obj.name
+        Person(name='a').save()
+        self.assertEqual([label for pk, label in field.choices], ['a'])
+        formset = self.get_formset([{'name': 'a'}, {'name': 'b'}], initial=1)
+        self.assertTrue(formset.is_valid(), formset.errors)
+        formset.save()
+        self.assertEqual(sorted(label for pk, label in field.choices),
+                         ['a', 'b'])
+
+    def test_insert_and_update(self):
+        Person(name='a', age=1).save()
+        formset = self.get_formset([
+            {'name': 'a', 'age': '2'},
+            {'name': 'b', 'age': '3'},
+            {'name': 'c', 'age': '4'},
+        ], initial=1)
+        self.assertTrue(formset.is_valid(), formset.errors)
+        saved = formset.save()
+        self.assertEqual(len(saved), 3)
+        self.assertTrue(all(obj.pk is not None for obj in saved))
+        self.assertEqual(
+            [(p.name, p.age) for p in Person.objects.order_by('name')],
+            [('a', 2), ('b', 3), ('c', 4)])
+
+    def test_delete(self):
+        Person(name='a').save()
+        Person(name='b').save()
+        formset = self.get_formset([{'name': 'a', 'DELETE': 'on'},
+                                    {'name': 'b'}], initial=2)
+        self.assertTrue(formset.is_valid(), formset.errors)
+        formset.save()
+        self.assertEqual([p.name for p in Person.objects], ['b'])
+
+    def test_failed_insert(self):
+        formset = self.get_formset([{'name': 'a'}, {'name': 'b'}])
+        self.assertTrue(formset.is_valid(), formset.errors)
+        # written by someone else after validation
+        Person(name='b').save()
+        Person.ensure_indexes()
+        saved = formset.save()
+        self.assertEqual([obj.name for obj in saved], ['a'])
+        self.assertTrue(formset.forms[1].errors)
+
+
+class ChoiceIteratorTest(MongoTestCase):
+    documents = (Person,)
+
+    def test_len_respects_slices(self):
+        for name in 'abcd':
+            Person(name=name).save()
+        field = ReferenceField(Person.objects.order_by('name')[1:3],
+                               empty_label=None)
+        self.assertEqual(len(field.choices), 2)
+        self.assertEqual([label for pk, label in field.choices],
+                         ['Person object', 'Person object'])
+
+
+class ReferenceSearchViewTest(MongoTestCase):
+    documents = (Person,)
+
+    def setUp(self):
+        super(ReferenceSearchViewTest, self).setUp()
+        for name, code in [('bert', 'an1'), ('anton', 'x'), ('anna', 'y')]:
+            Person(name=name, code=code, age=30).save()
+
+    def search(self, view, **params):
+        response = view(RequestFactory().get('/search/', params))
+        self.assertEqual(response['Content-Type'], 'application/json')
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_response(self):
+        view = reference_search_view(Person.objects, ['name'],
+                                     label_from_instance=lambda p: p.name)
+        anna = Person.objects.get(name='anna')
+        self.assertEqual(self.search(view, q='anna'), {
+            'results': [{'id': str(anna.pk), 'text': 'anna'}],
+            'more': False,
+        })
+
+    def test_filters_by_prefix(self):
+        view = reference_search_view(Person.objects, ['name'],
+                                     label_from_instance=lambda p: p.name)
+        data = self.search(view, q='an')
+        self.assertEqual([r['text'] for r in data['results']],
+                         ['anna', 'anton'])
+        self.assertEqual(self.search(view, q='nna')['results'], [])
+        self.assertEqual(self.search(view, q='')['results'], [])
+
+        view = reference_search_view(Person.objects, ['name', 'code'],
+                                     label_fields=['name'],
+                                     label_from_instance=lambda p: p.name)
+        data = self.search(view, q='an')
+        self.assertEqual([r['text'] for r in data['results']],
+                         ['anna', 'anton', 'bert'])
+
+    def test_only_loads_label_fields(self):
+        view = reference_search_view(
+            Person.objects, ['name'],
+            label_from_instance=lambda p: '%s %s' % (p.name, p.age))
+        data = self.search(view, q='anna')
+        self.assertEqual(data['results'][0]['text'], 'anna None')
+
+    def test_limit(self):
+        view = reference_search_view(Person.objects, ['name', 'code'],
+                                     label_from_instance=lambda p: p.name,
+                                     paginate_by=2)
+        data = self.search(view, q='an')
+        self.assertEqual([r['text'] for r in data['results']],
+                         ['anna', 'anton'])
+        self.assertTrue(data['more'])
+        data = self.search(view, q='an', page='2')
+        self.assertEqual([r['text'] for r in data['results']], ['bert'])
+        self.assertFalse(data['more'])
+        data = self.search(view, q='an', page='x')
+        self.assertEqual(len(data['results']), 2)
+
+
+class ReferenceSearchWidgetTest(MongoTestCase):
+    documents = (Person,)
+
+    def test_renders_selected_choices(self):
+        widget = ReferenceSearchWidget('/search/',
+                                       choices=[('a', 'A'), ('b', 'B')])
+        html = widget.render('person', 'b', attrs={'id': 'id_person'})
+        self.assertIn('data-search-url="/search/"', html)
+        self.assertIn('id="id_person"', html)
+        self.assertIn('<option value="b" selected="selected">B</option>',
+                      html)
+        self.assertNotIn('value="a"', html)
+        self.assertEqual(len(widget.choices), 2)
+
+    def test_renders_nothing_without_value(self):
+        widget = ReferenceSearchWidget('/search/',
+                                       choices=[('a', 'A'), ('b', 'B')])
+        html = widget.render('person', None)
+        self.assertIn('data-search-url="/search/"', html)
+        self.assertNotIn('<option', html)
+
+    def test_multiple(self):
+        widget = ReferenceSearchMultipleWidget(
+            '/search/', choices=[('a', 'A'), ('b', 'B'), ('c', 'C')])
+        html = widget.render('people', ['a', 'c'])
+        self.assertIn('multiple="multiple"', html)
+        self.assertIn('value="a"', html)
+        self.assertIn('value="c"', html)
+        self.assertNotIn('value="b"', html)
+
+    def test_reference_field(self):
+        anna = Person(name='anna').save()
+        Person(name='bert').save()
+        field = ReferenceField(Person.objects, empty_label=None,
+                               widget=ReferenceSearchWidget('/search/'))
+        field.label_from_instance = lambda obj: obj.name
+        html = field.widget.render('person', str(anna.pk))
+        self.assertIn('>anna</option>', html)
+        self.assertNotIn('bert', html)
+        self.assertEqual(field.widget.render('person', 'invalid').count(
+            '<option'), 0)
+
+
+class ChoiceCacheTest(MongoTestCase):
+    documents = (Person, Pet)
+
+    def setUp(self):
+        super(ChoiceCacheTest, self).setUp()
+        choicecache._get_cache().clear()
+
+    def names(self, field):
+        return sorted(label for pk, label in field.choices)
+
+    def test_save_and_delete_invalidate(self):
+        field = ReferenceField(Person.objects, empty_label=None,
+                               choice_cache_timeout=60)
+        field.label_from_instance = lambda obj: obj.name
+        a = Person(name='a').save()
+        self.assertEqual(self.names(field), ['a'])
+        # writes without signals are not noticed
+        Person._get_collection().insert_one({'name': 'b'})
+        self.assertEqual(self.names(field), ['a'])
+        Person(name='c').save()
+        self.assertEqual(self.names(field), ['a', 'b', 'c'])
+        a.delete()
+        self.assertEqual(self.names(field), ['b', 'c'])
+
+    def test_label_functions(self):
+        Person(name='a').save()
+
+        def upper(obj):
+            return obj.name.upper()
+
+        def lower(obj):
+            return obj.name.lower()
+        labels = []
+        for label in (upper, lower):
+            field = ReferenceField(Person.objects, empty_label=None,
+                                   choice_cache_timeout=60)
+            field.label_from_instance = label
+            labels.append(self.names(field))
+        self.assertEqual(labels, [['A'], ['a']])
+
+    def test_choice_cache_key(self):
+        Person(name='a').save()
+        labels = []
+        for key, label in (('one', 'x'), ('two', 'y'), ('one', 'z')):
+            field = ReferenceField(Person.objects, empty_label=None,
+                                   choice_cache_timeout=60,
+                                   choice_cache_key=key)
+            field.label_from_instance = lambda obj, label=label: label
+            labels.append(self.names(field))
+        self.assertEqual(labels, [['x'], ['y'], ['x']])
+
+    def test_invalidates_uncached_collections(self):
+        # another process may have cached choices of this collection
+        ReferenceField(Person.objects, choice_cache_timeout=60)
+        cache = choicecache._get_cache()
+        generation = choicecache._get_generation(cache, 'person')
+        Person(name='a').save()
+        self.assertNotEqual(choicecache._get_generation(cache, 'person'),
+                            generation)
+
+    def test_ignores_other_documents(self):
+        ReferenceField(Person.objects, choice_cache_timeout=60)
+        Pet(name='a').save()
+        key = choicecache._generation_key(Pet._get_collection_name())
+        self.assertEqual(choicecache._get_cache().get(key), None)
+
+
+class Upload(mongoengine.Document):
+    file = mongoengine.FileField()
+    gallery = mongoengine.ListField(mongoengine.FileField())
+
+
+class UpperCaseProxy(mongoengine.fields.GridFSProxy):
+    """Changes files when writing them, like ImageGridFsProxy."""
+
+    def put(self, file_obj, **kwargs):
+        content = io.BytesIO(file_obj.read().upper())
+        super(UpperCaseProxy, self).put(content, **kwargs)
+
+
+class UpperCaseFileField(mongoengine.FileField):
+    proxy_class = UpperCaseProxy
+
+
+class Shout(mongoengine.Document):
+    file = UpperCaseFileField()
+
+
+class FileStorageTest(GridFSTestCase):
+    documents = (Upload,)
+
+    def put(self, name, content, field=None):
+        field = field or Upload.file
+        proxy = Upload().file
+        put_file(proxy, SimpleUploadedFile(name, content), field)
+        return proxy
+
+    def test_put_file(self):
+        first = self.put('a.txt', b'first')
+        second = self.put('a.txt', b'second')
+        self.assertEqual(first.read(), b'first')
+        self.assertEqual(second.read(), b'second')
+        self.assertEqual(self.filenames(), ['a.txt', 'a_1.txt'])
+
+    def test_deduplicate(self):
+        field = mongoengine.FileField()
+        field.deduplicate = True
+        first = self.put('a.txt', b'content', field)
+        second = self.put('b.txt', b'content', field)
+        self.assertEqual(first.grid_id, second.grid_id)
+        doc = self.db['fs.files'].find_one()
+        self.assertEqual(doc['sha256'],
+                         hashlib.sha256(b'content').hexdigest())
+        self.assertEqual(doc['refcount'], 2)
+        self.assertEqual(self.db['fs.files'].count(), 1)
+
+        delete_file(second)
+        self.assertEqual(first.read(), b'content')
+        delete_file(first)
+        self.assertEqual(self.db['fs.files'].count(), 0)
+        self.assertEqual(self.db['fs.chunks'].count(), 0)
+
+    def test_own_put(self):
+        field = Shout.file
+        field.deduplicate = True
+        try:
+            shout = Shout()
+            put_file(shout.file, SimpleUploadedFile('a.txt', b'loud'), field)
+            old_grid_id = shout.file.grid_id
+            put_file(shout.file, SimpleUploadedFile('a.txt', b'louder'),
+                     field)
+        finally:
+            del field.deduplicate
+        self.assertNotEqual(shout.file.grid_id, old_grid_id)
+        self.assertEqual(shout.file.read(), b'LOUDER')
+        self.assertEqual(self.filenames(), ['a.txt', 'a_1.txt'])
+        self.assertFalse('sha256' in self.db['fs.files'].find_one())
+
+
+class OtherUpload(mongoengine.Document):
+    file = mongoengine.FileField(collection_name='other')
+
+
+class UploadHandlerTest(GridFSTestCase):
+    documents = (Upload, Shout)
+
+    def upload(self, name, chunks):
+        handler = GridFSUploadHandler()
+        self.assertRaises(StopFutureHandlers, handler.new_file, 'file', name,
+                          'text/plain', None)
+        for chunk in chunks:
+            self.assertEqual(handler.receive_data_chunk(chunk, 0), None)
+        return handler.file_complete(sum(len(chunk) for chunk in chunks))
+
+    def test_upload(self):
+        upload = self.upload('a.txt', [b'some ', b'content'])
+        self.assertEqual(upload.read(), b'some content')
+        self.assertEqual(upload.size, 12)
+        self.assertEqual(upload.sha256,
+                         hashlib.sha256(b'some content').hexdigest())
+        doc = self.db['fs.files'].find_one({'_id': upload.grid_id})
+        self.assertTrue(doc['pending'])
+
+    def test_interrupted(self):
+        handler = GridFSUploadHandler()
+        self.assertRaises(StopFutureHandlers, handler.new_file, 'file',
+                          'a.txt', 'text/plain', None)
+        handler.receive_data_chunk(b'x' * 300 * 1024, 0)
+        handler.upload_interrupted()
+        self.assertEqual(self.db['fs.chunks'].count(), 0)
+
+    def test_adopt(self):
+        self.db['fs.files'].insert_one({'filename': 'a.txt'})
+        upload = self.upload('a.txt', [b'content'])
+        proxy = Upload().file
+        put_file(proxy, upload, Upload.file)
+        self.assertEqual(proxy.grid_id, upload.grid_id)
+        doc = self.db['fs.files'].find_one({'_id': upload.grid_id})
+        self.assertEqual(doc['filename'], 'a_1.txt')
+        self.assertFalse('pending' in doc)
+
+    def test_other_gridfs_copies(self):
+        upload = self.upload('a.txt', [b'content'])
+        proxy = OtherUpload().file
+        try:
+            put_file(proxy, upload, OtherUpload.file)
+            self.assertEqual(proxy.read(), b'content')
+            self.assertEqual(self.db['fs.files'].count(), 0)
+            self.assertEqual(self.db['fs.chunks'].count(), 0)
+        finally:
+            self.db['other.files'].drop()
+            self.db['other.chunks'].drop()
+
+    def test_own_put_copies(self):
+        upload = self.upload('a.txt', [b'content'])
+        shout = Shout()
+        put_file(shout.file, upload, Shout.file)
+        self.assertNotEqual(shout.file.grid_id, upload.grid_id)
+        self.assertEqual(shout.file.read(), b'CONTENT')
+        self.assertEqual(self.filenames(), ['a.txt'])
+
+
+class ListFilesTest(GridFSTestCase):
+    documents = (Upload,)
+
+    def test_same_names(self):
+        upload = Upload()
+        uploads = [SimpleUploadedFile('a.txt', content)
+                   for content in (b'1', b'2', b'3')]
+        replaced = DeletionQueue()
+        _save_list_files(Upload.gallery, upload, uploads, 4, replaced)
+        self.assertEqual([proxy.read() for proxy in upload.gallery],
+                         [b'1', b'2', b'3'])
+        self.assertEqual(self.filenames(), ['a.txt', 'a_1.txt', 'a_2.txt'])
+
+
+class PrefetchReferencesTest(MongoTestCase):
+    documents = (Person, Pet)
+
+    def test_one_query_per_queryset(self):
+        a = Person(name='a').save()
+        b = Person(name='b').save()
+        formset_class = documentformset_factory(Pet, fields=['name', 'owner'],
+                                                extra=0)
+        rows = [{'name': 'x', 'owner': str(a.pk)},
+                {'name': 'y', 'owner': str(b.pk)},
+                {'name': 'z', 'owner': str(a.pk)},
+                {'name': 'w', 'owner': str(Pet().save().pk)}]
+        formset = formset_class(formset_data(rows))
+
+        finds = []
+        find = mongomock.collection.Collection.find
+
+        def counting_find(collection, *args, **kwargs):
+            finds.append(collection.name)
+            return find(collection, *args, **kwargs)
+        mongomock.collection.Collection.find = counting_find
+        try:
+            self.assertFalse(formset.is_valid())
+        finally:
+            mongomock.collection.Collection.find = find
+
+        self.assertEqual(finds.count('person'), 1)
+        owners = [form.cleaned_data.get('owner') for form in formset.forms]
+        self.assertEqual([owner.name for owner in owners[:3]],
+                         ['a', 'b', 'a'])
+        self.assertTrue(owners[0] is owners[2])
+        self.assertEqual(list(formset.errors[3]), ['owner'])
+
+
+class Photo(mongoengine.EmbeddedDocument):
+    file = mongoengine.FileField()
+
+
+class Album(mongoengine.Document):
+    cover = mongoengine.GenericEmbeddedDocumentField(choices=[Photo])
+
+
+class Scrapbook(mongoengine.Document):
+    page = mongoengine.GenericEmbeddedDocumentField()
+
+
+class GridFSCleanupTest(GridFSTestCase):
+    documents = (Upload, Shout, Album, Scrapbook)
+
+    def setUp(self):
+        super(GridFSCleanupTest, self).setUp()
+        self.upload = Upload()
+        put_file(self.upload.file, SimpleUploadedFile('a.txt', b'a'),
+                 Upload.file)
+        gallery = Upload().file
+        put_file(gallery, SimpleUploadedFile('b.txt', b'b'), Upload.file)
+        self.upload.gallery = [gallery]
+        self.upload.save()
+        self.orphan = Upload().file
+        put_file(self.orphan, SimpleUploadedFile('c.txt', b'c'), Upload.file)
+        self.db['fs.chunks'].insert_one({'files_id': ObjectId(), 'n': 0,
+                                         'data': b'd'})
+
+    def cleanup(self, **options):
+        out = StringIO()
+        self.err = StringIO()
+        call_command('gridfs_cleanup', older_than=-1, stdout=out,
+                     stderr=self.err, **options)
+        return out.getvalue()
+
+    def photo(self, name):
+        photo = Photo()
+        put_file(photo.file, SimpleUploadedFile(name, b'photo'),
+                 Photo.file)
+        return photo
+
+    def test_generic_embedded_choices(self):
+        Album(cover=self.photo('cover.jpg')).save()
+        out = self.cleanup()
+        self.assertIn('Deleted 1 orphaned files', out)
+        self.assertEqual(self.filenames(), ['a.txt', 'b.txt', 'cover.jpg'])
+
+    def test_generic_embedded_without_choices(self):
+        Scrapbook(page=self.photo('page.jpg')).save()
+        out = self.cleanup()
+        self.assertIn('Deleted 1 orphaned files', out)
+        self.assertEqual(self.filenames(), ['a.txt', 'b.txt', 'page.jpg'])
+        self.assertIn('Scrapbook.page is a generic embedded document field '
+                      'without choices', self.err.getvalue())
+
+    def test_dry_run(self):
+        out = self.cleanup(dry_run=True)
+        self.assertIn('Found 1 orphaned files and the chunks of 1 missing '
+                      'files in default.fs', out)
+        self.assertEqual(self.filenames(), ['a.txt', 'b.txt', 'c.txt'])
+        self.assertEqual(self.db['fs.chunks'].count(), 4)
+
+    def test_cleanup(self):
+        out = self.cleanup(batch_size=1)
+        self.assertIn('Deleted 1 orphaned files and the chunks of 1 missing '
+                      'files in default.fs', out)
+        self.assertEqual(self.filenames(), ['a.txt', 'b.txt'])
+        self.assertEqual(self.db['fs.chunks'].count(), 2)
+        self.assertEqual(self.upload.gallery[0].read(), b'b')
+
+    def test_keeps_new_files(self):
+        out = StringIO()
+        call_command('gridfs_cleanup', stdout=out, stderr=StringIO())
+        self.assertIn('Deleted 0 orphaned files and the chunks of 0 missing '
+                      'files in default.fs', out.getvalue())
+        self.assertEqual(self.filenames(), ['a.txt', 'b.txt', 'c.txt'])
+
+
+class SharedFileField(mongoengine.FileField):
+    deduplicate = True
+
+
+class Shared(mongoengine.Document):
+    name = mongoengine.StringField()
+    file = SharedFileField()
+
+
+class DeleteDocumentTest(GridFSTestCase):
+    documents = (Shared,)
+
+    def create(self, name):
+        shared = Shared(name=name)
+        put_file(shared.file, SimpleUploadedFile('a.txt', b'content'),
+                 Shared.file)
+        return shared.save()
+
+    def test_keeps_shared_file(self):
+        first, second = self.create('a'), self.create('b')
+        self.assertEqual(first.file.grid_id, second.file.grid_id)
+        delete_document(first)
+        self.assertEqual(Shared.objects.count(), 1)
+        self.assertEqual(Shared.objects.get().file.read(), b'content')
+        delete_document(second)
+        self.assertEqual(self.db['fs.files'].count(), 0)
+        self.assertEqual(self.db['fs.chunks'].count(), 0)
+
+    def test_bulk_delete(self):
+        self.create('a')
+        self.create('b')
+        formset_class = documentformset_factory(
+            Shared, formset=BulkFormSet, fields=['name'], can_delete=True,
+            extra=0)
+        formset = formset_class(formset_data(
+            [{'name': 'a', 'DELETE': 'on'}, {'name': 'b'}], initial=2),
+            queryset=Shared.objects.order_by('name'))
+        self.assertTrue(formset.is_valid(), formset.errors)
+        formset.save()
+        self.assertEqual(Shared.objects.get().file.read(), b'content')
+        self.assertEqual(self.db['fs.files'].find_one()['refcount'], 1)
+
+    def test_formset_delete(self):
+        self.create('a')
+        self.create('b')
+        formset_class = documentformset_factory(
+            Shared, formset=EditFormSet, fields=['name'], can_delete=True,
+            extra=0)
+        queryset = Shared.objects.order_by('name')
+        formset = formset_class(formset_data(
+            [{'name': 'a', 'DELETE': 'on'}, {'name': 'b'}], initial=2),
+            queryset=queryset)
+        self.assertTrue(formset.is_valid(), formset.errors)
+        formset.save()
+        self.assertEqual(Shared.objects.get().file.read(), b'content')
+
+
+class Gallery(mongoengine.Document):
+    name = mongoengine.StringField(unique=True)
+    files = mongoengine.ListField(mongoengine.FileField())
+
+
+class ReplaceFileTest(GridFSTestCase):
+    documents = (Gallery,)
+
+    def test_old_file_survives_failed_save(self):
+        Gallery(name='taken').save()
+        gallery = Gallery(name='a')
+        _save_list_files(Gallery.files, gallery,
+                         [SimpleUploadedFile('a.txt', b'old')], 1,
+                         DeletionQueue())
+        gallery.save()
+        old_grid_id = gallery.files[0].grid_id
+
+        replaced = DeletionQueue()
+        new = _save_iterator_file(Gallery.files, gallery,
+                                  SimpleUploadedFile('a.txt', b'new'),
+                                  file_data=gallery.files[0],
+                                  replaced=replaced)
+        self.assertEqual(new.read(), b'new')
+        self.assertEqual(len(replaced), 1)
+        gallery.name = 'taken'
+        self.assertRaises(mongoengine.NotUniqueError, gallery.save)
+
+        stored = Gallery.objects.get(name='a').files[0]
+        self.assertEqual(stored.grid_id, old_grid_id)
+        self.assertEqual(stored.read(), b'old')
@@ -0,0 +1,93 @@
+"""
+An upload handler that streams uploaded files straight into GridFS.
+
+Add ``'mongodbforms.uploadhandler.GridFSUploadHandler'`` to
+``FILE_UPLOAD_HANDLERS`` to use it. Files are written to the GridFS given
+by the ``MONGODBFORMS_UPLOAD_DB_ALIAS`` and
+``MONGODBFORMS_UPLOAD_COLLECTION`` settings while the request is parsed.
+File fields that store their files in the same GridFS take the written
+file over without copying it. Files of forms that are never saved stay
+behind with ``pending: true`` in their files document.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import (FileUploadHandler,
+                                             StopFutureHandlers)
+
+from mongoengine.connection import get_db, DEFAULT_CONNECTION_NAME
+from bson.objectid import ObjectId
+from gridfs import GridFS
+
+
+class GridFSUploadedFile(UploadedFile):
+    """
+    A file written to GridFS by ``GridFSUploadHandler``. Reading it reads
+    the stored file.
+    """
+
+    def __init__(self, grid_out, name, content_type, size, charset,
+                 sha256, db_alias, collection_name):
+        super(GridFSUploadedFile, self).__init__(grid_out, name,
+                                                 content_type, size, charset)
+        self.grid_id = grid_out._id
+        self.sha256 = sha256
+        self.db_alias = db_alias
+        self.collection_name = collection_name
+
+
+class GridFSUploadHandler(FileUploadHandler):
+    """
+    Writes each uploaded file to GridFS as its data arrives and hashes it
+    on the way.
+    """
+
+    def __init__(self, request=None):
+        super(GridFSUploadHandler, self).__init__(request)
+        self.db_alias = getattr(settings, 'MONGODBFORMS_UPLOAD_DB_ALIAS',
+                                DEFAULT_CONNECTION_NAME)
+        self.collection_name = getattr(settings,
+                                       'MONGODBFORMS_UPLOAD_COLLECTION', 'fs')
+        self.grid_in = None
+
+    def _get_fs(self):
+        return GridFS(get_db(self.db_alias), self.collection_name)
+
+    def new_file(self, *args, **kwargs):
+        super(GridFSUploadHandler, self).new_file(*args, **kwargs)
+        grid_id = ObjectId()
+        options = {
+            '_id': grid_id,
+            # the real name is chosen when a form saves the file
+            'filename': '.upload-%s' % grid_id,
+            'content_type': self.content_type,
+            'pending': True,
+        }
+        chunk_size = getattr(settings, 'MONGODBFORMS_GRIDFS_CHUNK_SIZE', None)
+        if chunk_size is not None:
+            options['chunk_size'] = chunk_size
+        self.grid_in = self._get_fs().new_file(**options)
+        self.digest = hashlib.sha256()
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.grid_in.write(raw_data)
+        self.digest.update(raw_data)
+        # nothing is left for other handlers
+        return None
+
+    def file_complete(self, file_size):
+        self.grid_in.close()
+        grid_out = self._get_fs().get(self.grid_in._id)
+        self.grid_in = None
+        return GridFSUploadedFile(grid_out, self.file_name, self.content_type,
+                                  file_size, self.charset,
+                                  self.digest.hexdigest(), self.db_alias,
+                                  self.collection_name)
+
+    def upload_interrupted(self):
+        if self.grid_in is not None:
+            chunks = get_db(self.db_alias)['%s.chunks' % self.collection_name]
+            chunks.delete_many({'files_id': self.grid_in._id})
+            self.grid_in = None
@@ -1,8 +1,9 @@
-from collections import defaultdict
+import threading
+from collections import defaultdict, OrderedDict
 
 from django.conf import settings
 
-from mongodbforms.documentoptions import DocumentMetaWrapper, LazyDocumentMetaWrapper
+from mongodbforms.documentoptions import get_meta_wrapper
 from mongodbforms.fieldgenerator import MongoDefaultFormFieldGenerator
 
 try:
@@ -50,8 +51,7 @@ def load_field_generator():
 
 
 def init_document_options(document):
-    if not isinstance(document._meta, (DocumentMetaWrapper, LazyDocumentMetaWrapper)):
-        document._meta = DocumentMetaWrapper(document)
+    get_meta_wrapper(document)
     # Workaround for Django 1.7+
     document._deferred = False
     # FIXME: Wrong implementation for Relations (https://github.com/django/django/blob/master/django/db/models/base.py#L601)
@@ -60,7 +60,7 @@ def init_document_options(document):
 
 
 def get_document_options(document):
-    return DocumentMetaWrapper(document)
+    return get_meta_wrapper(document)
 
 
 def format_mongo_validation_errors(validation_exception):
@@ -83,6 +83,58 @@ def format_mongo_validation_errors(validation_exception):
     return ["%s: %s" % (k, v) for k, v in error_dict.iteritems()]
 
 
+class LRUCache(object):
+    """
+    A thread safe mapping that holds at most ``maxsize`` entries and drops
+    the least recently used ones first. A ``maxsize`` of 0 disables it.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # re-insert to mark it as the most recently used entry
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+
 # Taken from six (https://pypi.python.org/pypi/six)
 # by "Benjamin Peterson <benjamin@python.org>"
 #
@@ -0,0 +1,72 @@
+import json
+import operator
+from functools import reduce
+
+from django.http import HttpResponse
+try:
+    from django.utils.encoding import smart_text as smart_unicode
+except ImportError:
+    try:
+        from django.utils.encoding import smart_unicode
+    except ImportError:
+        from django.forms.util import smart_unicode
+try:
+    from django.utils.encoding import force_text as force_unicode
+except ImportError:
+    from django.utils.encoding import force_unicode
+
+from mongoengine.queryset import Q
+
+
+def reference_search_view(queryset, search_fields, label_fields=None,
+                          label_from_instance=smart_unicode, paginate_by=20,
+                          text_search=False, min_length=1):
+    """
+    Returns a view that searches ``queryset`` for the search widgets in
+    ``mongodbforms.widgets``.
+
+    The search term is taken from the ``q`` GET parameter and the page from
+    ``page``. By default documents are found if one of ``search_fields``
+    starts with the term, which is a case sensitive prefix search that can
+    use an index on the field. If ``text_search`` is True a ``$text`` query
+    is made instead, which needs a text index on the collection.
+
+    Only the pk and ``label_fields`` (``search_fields`` by default) are
+    loaded. The response is JSON of the form
+    ``{"results": [{"id": ..., "text": ...}], "more": true}``.
+    """
+    if label_fields is None:
+        label_fields = search_fields
+
+    def view(request):
+        term = request.GET.get('q', '').strip()
+        try:
+            page = max(int(request.GET.get('page', 1)), 1)
+        except ValueError:
+            page = 1
+
+        results = []
+        more = False
+        if len(term) >= min_length:
+            qs = queryset.clone()
+            if text_search:
+                qs = qs.filter(__raw__={'$text': {'$search': term}})
+            else:
+                q_list = [Q(**{'%s__startswith' % f: term})
+                          for f in search_fields]
+                qs = qs.filter(reduce(operator.or_, q_list))
+                qs = qs.order_by(*search_fields)
+            qs = qs.only(*label_fields)
+            # fetch one more document to know if there is another page
+            offset = (page - 1) * paginate_by
+            objs = list(qs.skip(offset).limit(paginate_by + 1))
+            more = len(objs) > paginate_by
+            results = [{
+                'id': force_unicode(obj.pk),
+                'text': force_unicode(label_from_instance(obj)),
+            } for obj in objs[:paginate_by]]
+
+        data = json.dumps({'results': results, 'more': more})
+        return HttpResponse(data, content_type='application/json')
+
+    return view
@@ -2,8 +2,13 @@ import copy
 
 from django.forms.widgets import (Widget, Media, TextInput,
                                   SplitDateTimeWidget, DateInput, TimeInput,
-                                  MultiWidget, HiddenInput)
+                                  MultiWidget, HiddenInput, Select,
+                                  SelectMultiple)
 from django.utils.safestring import mark_safe
+try:
+    from django.utils.encoding import force_text as force_unicode
+except ImportError:
+    from django.utils.encoding import force_unicode
 from django.core.validators import EMPTY_VALUES
 from django.forms.util import flatatt
 
@@ -176,3 +181,44 @@ class HiddenMapWidget(MapWidget):
         data_widget = HiddenInput()
         super(MapWidget, self).__init__(data_widget, attrs)
         self.key_widget = HiddenInput()
+
+
+class ReferenceSearchWidget(Select):
+    """
+    A select for reference fields that only renders the selected documents
+    as options. The other documents are meant to be searched on the client
+    side using ``search_url``, which is rendered as ``data-search-url``
+    attribute. See ``mongodbforms.views.reference_search_view``.
+    """
+    def __init__(self, search_url, attrs=None, choices=()):
+        super(ReferenceSearchWidget, self).__init__(attrs, choices)
+        self.search_url = search_url
+
+    def selected_values(self, value):
+        if value in EMPTY_VALUES:
+            return []
+        return [value]
+
+    def render(self, name, value, attrs=None, *args, **kwargs):
+        values = self.selected_values(value)
+        all_choices = self.choices
+        if hasattr(all_choices, 'for_values'):
+            self.choices = list(all_choices.for_values(values))
+        else:
+            values = set(force_unicode(v) for v in values)
+            self.choices = [c for c in all_choices
+                            if force_unicode(c[0]) in values]
+        attrs = dict(attrs or {})
+        attrs['data-search-url'] = force_unicode(self.search_url)
+        try:
+            return super(ReferenceSearchWidget, self).render(
+                name, value, attrs, *args, **kwargs)
+        finally:
+            self.choices = all_choices
+
+
+class ReferenceSearchMultipleWidget(ReferenceSearchWidget, SelectMultiple):
+    def selected_values(self, value):
+        if value in EMPTY_VALUES:
+            return []
+        return list(value)
@@ -16,7 +16,8 @@ setup(name='mongodbforms',
     author='Jan Schrewe',
     author_email='jan@schafproductions.com',
     url='http://www.schafproductions.com/projects/django-mongodb-forms/',
-    packages=['mongodbforms',],
+    packages=['mongodbforms', 'mongodbforms.management',
+              'mongodbforms.management.commands'],
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Environment :: Web Environment',